@@ -1,68 +1,196 @@
-import numpy as np
+import argparse
+import json
+import os
+import shutil
+import time
 import faiss
+import numpy as np
 from chunking import chunking
-from sentence_transformers import SentenceTransformer
-from langchain.vectorstores import FAISS
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.schema import Document
+from bm25 import BM25Index
+from cache import EmbeddingCache, content_hash
+from indexing import BuildIndex, IndexReport, PrintIndexReport, index_types, index_type, normalize, removable_types, uses_inner_product
+from metastore import MetadataStore
+from filters import FilterIndex
+import registry
 
-#Paths for storing vector and metadata
-chunking_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+#Path of the vector store: index.faiss, the metadata columns, the BM25 and filter files
 vector_path = '../data/vectorstore'
-helper_path = '../data/helperData'
+#Row hashes and index version of the store, and the embeddings of every text seen so far
+manifest_file = registry.manifest_file
+embedding_cache_file = 'embeddings.sqlite'
+#A new version of the store is written here before it replaces the live files
+staging_dir = '.staging'
 
-#Chunking the Data
-def CreateVectorDB():
-    # Chunking the data
-    chunks = chunking()
+#Texts to embed and their metadata, one per chunk, from the chunks written by ingest.py
+def PrepareChunks():
+    texts_to_embed, metadata_list = chunking()
     print("Done with chunking")
+    return texts_to_embed, metadata_list
+
+#Hash of a row as the metadata store keeps it, so chunks and stored rows hash alike
+def RowHash(text, metadata):
+    values = {key: "" if value is None else str(value) for key, value in metadata.items()}
+    return content_hash(json.dumps([text, values], sort_keys=True, ensure_ascii=False))
+
+def LoadManifest():
+    manifest_path = os.path.join(vector_path, manifest_file)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def SaveManifest(index, row_hashes, version):
+    manifest = {
+        'version': version,
+        'model': registry.embedding_model,
+        'index_type': index_type(index),
+        'n_rows': len(row_hashes),
+        'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rows': row_hashes
+    }
+    path = os.path.join(vector_path, manifest_file)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    return manifest
+
+def OpenEmbeddingCache():
+    os.makedirs(vector_path, exist_ok=True)
+    return EmbeddingCache(os.path.join(vector_path, embedding_cache_file), registry.embedding_model)
+
+def Encode(texts):
+    return registry.get_embeddings(encoder='torch').client.encode(texts, show_progress_bar=True)
 
-    #Prepare Texts and Metadata for Embedding
-    texts_to_embed = []
-    metadata_list = []
-
-    for chunk in chunks:
-        combined_questions = chunk['questions']
-        texts_to_embed.append(combined_questions)
-        metadata_list.append({
-            'speaker': chunk['speakers'],
-            'shloka': chunk['sanskrit'],
-            'chapter': chunk['chapter'],
-            'verse': chunk['verse'],
-            'source':chunk['source'],
-            'translations': chunk['translations'],
-            'purport': chunk['purports']
-        })
+#Moves every file of the staging directory over its live counterpart. os.replace swaps the
+#directory entry only, so processes that memory-mapped the old files keep reading them intact.
+def PublishStaging(staging):
+    for directory, _, files in os.walk(staging):
+        target = os.path.join(vector_path, os.path.relpath(directory, staging))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(directory, name), os.path.join(target, name))
+    shutil.rmtree(staging)
 
+#Writes everything that is derived from the rows into the staging directory, publishes it and
+#writes the manifest last; serving processes reload when they see its new version
+def SaveStore(index, texts, metadatas, version):
+    staging = os.path.join(vector_path, staging_dir)
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    faiss.write_index(index, os.path.join(staging, "index.faiss"))
+    #Row i of the metadata store belongs to vector i
+    MetadataStore.write(staging, texts, metadatas)
+    #BM25 idf and document lengths are corpus-wide, so the postings are rebuilt from the texts
+    BM25Index.build(texts).save(staging)
+    FilterIndex.build(metadatas).save(staging)
+    PublishStaging(staging)
+    manifest = SaveManifest(index, [RowHash(text, metadata) for text, metadata in zip(texts, metadatas)], version)
+    print(f"Vector store version {version} saved with {index.ntotal} rows ({index.__class__.__name__})")
+    return manifest
+
+#Chunking the Data
+def CreateVectorDB(index_config=None):
+    texts_to_embed, metadata_list = PrepareChunks()
     print(f"Total clusters to embed: {len(texts_to_embed)}")
 
-    #Generate Embeddings
-    embeddings = chunking_model.encode(texts_to_embed, show_progress_bar=True)
+    #Generate Embeddings with the shared model, reusing the ones cached by earlier builds
+    cache = OpenEmbeddingCache()
+    embeddings = cache.embed(texts_to_embed, Encode)
+    cache.close()
     print("Embeddings generated")
 
-    #Create and Save FAISS Index
-    dimension = embeddings.shape[1]
-    faiss_index = faiss.IndexFlatL2(dimension)
-    faiss_index.add(embeddings)
+    #Create the FAISS Index of the configured type and save the store
+    faiss_index = BuildIndex(embeddings, index_config)
+    previous = LoadManifest()
+    SaveStore(faiss_index, texts_to_embed, metadata_list, previous['version'] + 1 if previous else 1)
+
+#Manifest of a store written before manifests existed. Its vectors seed the embedding
+#cache when the index can give them back exactly.
+def BootstrapManifest(index, cache):
+    store = MetadataStore.load(vector_path)
+    documents = [store.get(row) for row in range(len(store))]
+    if index_type(index) in ('flat', 'hnsw'):
+        vectors = index.reconstruct_n(0, index.ntotal)
+        cache.put_many([content_hash(doc.page_content) for doc in documents], vectors)
+    return {
+        'version': 0,
+        'rows': [RowHash(doc.page_content, doc.metadata) for doc in documents]
+    }
+
+#Applies the difference between the chunks and the stored rows: rows whose hash disappeared are
+#removed, new or changed rows are embedded (cache misses only) and added. Unchanged rows keep
+#their vectors and their relative order; new rows go to the end.
+def UpdateVectorDB():
+    if not os.path.exists(os.path.join(vector_path, "index.faiss")) or not MetadataStore.exists(vector_path):
+        print("No vector store yet, building it from scratch")
+        return CreateVectorDB()
 
-    #Save metadata and FAISS index
-    np.save(f"{helper_path}/metadata.npy", metadata_list)
-    faiss.write_index(faiss_index, f"{helper_path}/hybrid_gita_questions.index")
-    print("FAISS Index Created")
+    texts, metadatas = PrepareChunks()
+    index = faiss.read_index(os.path.join(vector_path, "index.faiss"))
+    cache = OpenEmbeddingCache()
+    manifest = LoadManifest()
+    if manifest is None:
+        manifest = BootstrapManifest(index, cache)
+        SaveManifest(index, manifest['rows'], manifest['version'])
+    if len(manifest['rows']) != index.ntotal:
+        raise ValueError(f"Manifest has {len(manifest['rows'])} rows but the index has {index.ntotal}, rebuild the store")
 
-    #Integrate FAISS into LangChain
-    documents = [
-        Document(page_content=text, metadata=meta)
-        for text, meta in zip(texts_to_embed, metadata_list)
-    ]
+    #Match chunks to stored rows by hash, duplicates one to one
+    old_rows = {}
+    for row, row_hash in enumerate(manifest['rows']):
+        old_rows.setdefault(row_hash, []).append(row)
+    chunk_of_row = {}
+    added = []
+    for position, (text, metadata) in enumerate(zip(texts, metadatas)):
+        rows = old_rows.get(RowHash(text, metadata))
+        if rows:
+            chunk_of_row[rows.pop(0)] = position
+        else:
+            added.append(position)
+    removed = [row for row in range(index.ntotal) if row not in chunk_of_row]
+    print(f"{len(chunk_of_row)} rows unchanged, {len(removed)} removed, {len(added)} new or changed")
+    if not removed and not added:
+        cache.close()
+        print(f"Vector store version {manifest['version']} is up to date")
+        return manifest
 
-    hf_embeddings = HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2')
-    vector_store = FAISS.from_documents(documents, hf_embeddings)
+    order = [chunk_of_row[row] for row in sorted(chunk_of_row)] + added
+    new_texts = [texts[position] for position in order]
+    new_metadatas = [metadatas[position] for position in order]
 
-    # Save the LangChain vector store
-    vector_store.save_local(vector_path)
-    print("LangChain Vector Store Created and Saved")
+    if removed and index_type(index) not in removable_types:
+        #HNSW and IVF cannot drop vectors and keep row ids positional: rebuild from cached vectors
+        index = BuildIndex(cache.embed(new_texts, Encode), {'type': index_type(index)})
+    else:
+        if removed:
+            index.remove_ids(np.array(removed, dtype=np.int64))
+        if added:
+            vectors = cache.embed([texts[position] for position in added], Encode)
+            index.add(normalize(vectors) if uses_inner_product(index) else np.ascontiguousarray(vectors, dtype=np.float32))
+    cache.close()
+
+    return SaveStore(index, new_texts, new_metadatas, manifest['version'] + 1)
+
+#Compares every index type against the exact index on the vectors of the current store
+def CompareIndexTypes(k=10, n_queries=200):
+    index = registry.get_vectorstore(vector_path).index
+    embeddings = index.reconstruct_n(0, index.ntotal)
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)]
+    PrintIndexReport(IndexReport(embeddings, queries, k=k))
 
 if __name__ == "__main__":
-    print("Vector Database creation in progress.")
-    CreateVectorDB()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', choices=index_types, default='flat', help="FAISS index type to build")
+    parser.add_argument('--incremental', action='store_true', help="Only embed and apply rows that changed since the last build")
+    parser.add_argument('--report', action='store_true', help="Print recall and latency of every index type instead of building")
+    args = parser.parse_args()
+
+    if args.report:
+        CompareIndexTypes()
+    elif args.incremental:
+        print("Updating the Vector Database.")
+        UpdateVectorDB()
+    else:
+        print("Vector Database creation in progress.")
+        CreateVectorDB(index_config={'type': args.index})
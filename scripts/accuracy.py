@@ -1,97 +1,183 @@
-from retriever import Retriever
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
-from tqdm import tqdm 
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from tqdm import tqdm
 from langchain_community.llms import Ollama
 from langchain.prompts import PromptTemplate
+from retriever import batch_retrieval
+from indexing import index_type
+from chunking import chunks_path
+from checkpoint import Checkpoint
+import registry
 
-data = pd.read_csv("../data/processed/final.csv")
+data_path = chunks_path
 retrieval_vector_store = "../data/vectorstore"
-helperPath = "../data/helperData"
+checkpoint_path = "../data/evaluation"
 
-llm = Ollama(base_url='http://localhost:11434', model = 'llama3.2')
+judge_template = """Determine if the following document directly answers the query. Respond with "Yes" if it does, otherwise "No".
+            Query: {query}
+            Document: {doc}
+
+            Guidelines:
+            - No explanation is required.
+            - No other text is required.
+            - Just provide yes or no
+            """
+
+#Results are keyed by the question text, so a reordered or grown question set reuses them
+def question_key(question):
+    return hashlib.sha1(str(question).strip().encode('utf-8')).hexdigest()[:16]
 
 class Accuracy():
-    def __init__(self, vectorstorepath, data, llm=None):
+    def __init__(self, vectorstorepath, data, llm=None, k=15, alpha=0.5, batch_size=256, max_workers=8, checkpoint_dir=checkpoint_path):
         self.vectorstorepath = vectorstorepath
         self.data = data
         self.llm = llm
+        self.k = k
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.checkpoint_dir = checkpoint_dir
+        #Seconds spent in each stage, accumulated over the run
+        self.timings = {}
+        self._retrieved = None
 
     def LoadVectorStore(self):
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        vector_store = FAISS.load_local(
-            self.vectorstorepath,
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
-        return vector_store
+        return registry.get_vectorstore(self.vectorstorepath)
+
+    def LoadSparseIndex(self):
+        return registry.get_sparse_index(self.vectorstorepath)
+
+    def _timed(self, stage, start):
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    #Retrieved row ids of every question: questions are encoded in batches and each batch
+    #goes through one FAISS search and one sparse matrix product
+    def RetrieveAll(self):
+        if self._retrieved is not None:
+            return self._retrieved
+        vectorstore = self.LoadVectorStore()
+        sparse_index = self.LoadSparseIndex()
+        questions = self.data['question'].astype(str).tolist()
+
+        retrieved = []
+        for start in tqdm(range(0, len(questions), self.batch_size), desc="Retrieving", unit="batch"):
+            batch = questions[start:start + self.batch_size]
+            encode_start = time.perf_counter()
+            embeddings = vectorstore.embedding_function.embed_documents(batch)
+            self._timed('encode', encode_start)
+            results = batch_retrieval(batch, embeddings, vectorstore, sparse_index, k=self.k, alpha=self.alpha, timings=self.timings)
+            retrieved.extend(ids for ids, _ in results)
+
+        self._retrieved = retrieved
+        return retrieved
+
+    #Rows whose questions contain each evaluation question
+    def RelevantRows(self):
+        vectorstore = self.LoadVectorStore()
+        rows_by_question = {}
+        for row in range(vectorstore.index.ntotal):
+            document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[row])
+            for question in document.page_content.split('?'):
+                if question.strip():
+                    rows_by_question.setdefault(question.strip() + '?', set()).add(row)
+        return [rows_by_question.get(str(question).strip(), set()) for question in self.data['question']]
+
+    #recall@1/5/k and MRR of the rule-based match, plus the stage timings
+    def GetRetrievalMetrics(self):
+        retrieved = self.RetrieveAll()
+        relevant = self.RelevantRows()
+        ranks = []
+        for ids, rows in zip(retrieved, relevant):
+            hits = [position for position, row in enumerate(ids) if int(row) in rows]
+            ranks.append(hits[0] + 1 if hits else None)
+
+        reciprocal = np.array([1 / rank if rank else 0.0 for rank in ranks])
+        metrics = {
+            f"recall@{cutoff}": float(np.mean([rank is not None and rank <= cutoff for rank in ranks]))
+            for cutoff in sorted({1, 5, self.k})
+        }
+        metrics['mrr'] = float(reciprocal.mean())
+        metrics['timings'] = dict(self.timings)
+        return metrics
 
     def GetAccuracyRuleBased(self):
-        accuracy = 0
+        return self.GetRetrievalMetrics()[f"recall@{self.k}"]
+
+    #Everything the retrieved documents depend on; judged results are only reused for the same config
+    def RetrievalConfig(self):
         vectorstore = self.LoadVectorStore()
+        manifest_path = os.path.join(self.vectorstorepath, registry.manifest_file)
+        version = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                version = json.load(f).get('version')
+        return {
+            'store': os.path.abspath(self.vectorstorepath),
+            'version': version,
+            'chunks': vectorstore.index.ntotal,
+            'index': index_type(vectorstore.index),
+            'k': self.k,
+            'alpha': self.alpha
+        }
 
-        with tqdm(range(len(data)), desc="Calculating Accuracy", unit="query") as pbar:
-            for i in pbar:
-                query = data['question'].iloc[i]
-                similar_questions = Retriever(query, vectorstore=vectorstore).samay()
-                similar_questions_split = [
-                    q+'?' for doc in similar_questions
-                    for q in doc.page_content.split('?') if q.strip()
-                ]
-                if data['question'].iloc[i] in similar_questions_split:
-                    accuracy += 1
-
-                current_accuracy = accuracy / (i + 1)
-                pbar.set_description(f"Calculating Accuracy (Current: {current_accuracy:.2%})")
-
-        # Return final accuracy
-        return accuracy / len(data)
-    
-    def GetAccuracyLLM(self):
-        accuracy = 0
+    #Judges documents in rank order until the LLM says one answers the question
+    def JudgeQuestion(self, key, query, ids):
         vectorstore = self.LoadVectorStore()
-        prompt_template = PromptTemplate(
-            input_variables=["query", "doc"],
-            template="""Determine if the following document directly answers the query. Respond with "Yes" if it does, otherwise "No".
-            Query: {query}
-            Document: {doc}
+        prompt_template = PromptTemplate(input_variables=["query", "doc"], template=judge_template)
+        for position, row in enumerate(ids):
+            doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(row)])
+            response = self.llm(prompt_template.format(query=query, doc=doc.page_content))
+            if response.strip().lower().rstrip('.') == "yes":
+                return {'key': key, 'question': query, 'match': True, 'rank': position + 1}
+        return {'key': key, 'question': query, 'match': False, 'rank': None}
 
-            Guidelines:
-            - No explanation is required.
-            - No other text is required.
-            - Just provide yes or no
-            """
-        )
-
-        with tqdm(range(len(data)), desc="Calculating Accuracy", unit="query") as pbar:
-            for i in pbar:
-                query = data['question'].iloc[i]
-                similar_docs = Retriever(query, vectorstore=vectorstore).samay()
-                
-                # LLM-based comparison
-                match_found = False
-                for doc in similar_docs:
-                    prompt = prompt_template.format(query=query, doc=doc.page_content)
-                    response = self.llm(prompt)
-                    if response.strip().lower().rstrip('.') == "yes":
-                        match_found = True
-                        break
-
-                if match_found:
-                    accuracy += 1
-                
-                current_accuracy = accuracy / (i + 1)
-                pbar.set_description(f"Calculating Accuracy (Current: {current_accuracy:.2%})")
-
-        return accuracy / len(data)
+    #LLM-judged accuracy; questions are judged concurrently and checkpointed as they finish,
+    #in a checkpoint named after the retrieval config
+    def GetAccuracyLLM(self, checkpoint_name="llm_judge"):
+        retrieved = self.RetrieveAll()
+        config = self.RetrievalConfig()
+        digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        checkpoint = Checkpoint(os.path.join(self.checkpoint_dir, f"{checkpoint_name}_{digest}.jsonl"), header=config)
+        questions = self.data['question'].astype(str).tolist()
+        keys = [question_key(question) for question in questions]
+        #Position of each question still to judge; repeated questions are judged once
+        pending = {}
+        for i, key in enumerate(keys):
+            if key not in checkpoint.results:
+                pending.setdefault(key, i)
+        print(f"Resuming with {len(checkpoint.results)} questions already judged ({checkpoint.path})")
+
+        judge_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self.JudgeQuestion, keys[i], questions[i], retrieved[i])
+                for i in pending.values()
+            ]
+            with tqdm(as_completed(futures), total=len(futures), desc="Judging", unit="query") as pbar:
+                for future in pbar:
+                    checkpoint.add(future.result())
+                    matches = sum(result['match'] for result in checkpoint.results.values())
+                    pbar.set_description(f"Judging (Current: {matches / len(checkpoint.results):.2%})")
+        self._timed('judge', judge_start)
+
+        results = [checkpoint.results[key] for key in keys]
+        return sum(result['match'] for result in results) / len(results)
 
 if __name__ == "__main__":
+    data = pd.read_parquet(data_path)
+    llm = Ollama(base_url='http://localhost:11434', model = 'llama3.2')
     accuracy = Accuracy(data=data, vectorstorepath=retrieval_vector_store, llm=llm)
-    final_accuracy_rule_based = accuracy.GetAccuracyRuleBased()
+    metrics = accuracy.GetRetrievalMetrics()
     final_accuracy_llm_based = accuracy.GetAccuracyLLM()
-    print(f"Final Accuracy Rule Based: {final_accuracy_rule_based:.2%}")
+    print(f"Final Accuracy Rule Based: {metrics[f'recall@{accuracy.k}']:.2%}")
+    for name, value in metrics.items():
+        if name != 'timings':
+            print(f"{name}: {value:.4f}")
     print(f"Final Accuracy LLM Based: {final_accuracy_llm_based:.2%}")
+    for stage, seconds in accuracy.timings.items():
+        print(f"{stage}: {seconds:.2f}s")
@@ -1,17 +1,134 @@
+import json
+import logging
 import flask_cors
 import flask
-from chat import GetAnswer
+from pipeline import Pipeline
+from serving import OllamaClient, QueryService, Overloaded
+from onnx_encoder import ValidateEncoder
+from filters import check_filters
+import registry
+import tracing
+
+retrieval_vector_store = "../data/vectorstore"
+
+#Per-request prompt sizes are logged at INFO level, slow requests at WARNING
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+#Query encoder: 'torch', or 'onnx' to opt in to the int8 ONNX Runtime export (python onnx_encoder.py
+#--export). The export is refused when its top-k results drift too far from the stored index.
+query_encoder = 'torch'
+if query_encoder == 'onnx':
+    registry.use_encoder('onnx')
+    accepted, parity = ValidateEncoder(registry.get_vectorstore(retrieval_vector_store))
+    if not accepted:
+        print(f"ONNX encoder refused, top-10 overlap {parity['top10_overlap']:.3f}; using PyTorch")
+        registry.use_encoder('torch')
+
+llm = OllamaClient(base_url='http://localhost:11434', model='llama3.2')
+pipeline = Pipeline(path_vectorstore=retrieval_vector_store, llm=llm)
+service = QueryService(pipeline, max_workers=8, max_queue=32, timeout=120)
+
+#Requests slower than this are logged with their spans; set profile_rate (e.g. 0.05) to also
+#sample stacks of that fraction of requests and keep the profiles of the slow ones
+tracing.configure(slow_threshold=30.0, profile_rate=0.0)
+tracing.metrics.gauge('rag_requests_in_flight', lambda: service.in_flight, "Requests running or queued")
 
 app = flask.Flask(__name__)
 flask_cors.CORS(app)
 
+@app.errorhandler(Overloaded)
+def OverloadedError(error):
+    response = flask.jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+@app.errorhandler(TimeoutError)
+def TimeoutErrorHandler(error):
+    return flask.jsonify({'error': str(error)}), 504
+
+#Optional "filters" of a request body, e.g. {"source": "Gita", "chapter": [2, 3], "speaker": "Bhagwan"}
+def ParseFilters(data):
+    filters = data.get('filters') if isinstance(data, dict) else None
+    if filters is None:
+        return None
+    check_filters(filters)
+    return filters
+
 @app.route('/api/qa', methods=['POST'])
 def GetAnswerAPI():
     data = flask.request.json
     query = data['query']
-    response = GetAnswer(query)
+    try:
+        filters = ParseFilters(data)
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 400
+    response = service.GetAnswer(query, filters)
     return flask.jsonify({'response': response})
 
+#Server-sent events: the retrieval metadata first, then the answer token by token
+@app.route('/api/qa/stream', methods=['POST'])
+def StreamAnswerAPI():
+    data = flask.request.json
+    query = data['query']
+    try:
+        filters = ParseFilters(data)
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 400
+    service.acquire()
+
+    def events():
+        try:
+            for event in pipeline.StreamAnswer(query, filters):
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            service.release()
+
+    return flask.Response(
+        flask.stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+#Largest batch accepted by /api/qa/batch
+max_batch = 1000
+
+#Newline-delimited JSON, one {"index", "query", "response"} line per query as soon as it is answered.
+#The whole batch takes one slot of the service; generation inside it is bounded by the pipeline.
+@app.route('/api/qa/batch', methods=['POST'])
+def BatchAnswerAPI():
+    data = flask.request.json
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return flask.jsonify({'error': "'queries' must be a non-empty list"}), 400
+    if len(queries) > max_batch:
+        return flask.jsonify({'error': f"At most {max_batch} queries per batch"}), 400
+    invalid = [i for i, query in enumerate(queries) if not isinstance(query, str) or not query.strip()]
+    if invalid:
+        return flask.jsonify({'error': f"Every query must be a non-empty string, positions {invalid[:10]} are not"}), 400
+    try:
+        filters = ParseFilters(data)
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 400
+    service.acquire()
+
+    def lines():
+        try:
+            for i, response in pipeline.GetAnswers(queries, filters):
+                yield json.dumps({'index': i, 'query': queries[i], 'response': response}) + "\n"
+        finally:
+            service.release()
+
+    return flask.Response(
+        flask.stream_with_context(lines()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+#Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def MetricsAPI():
+    return flask.Response(tracing.metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    app.run(port=5000)
-    debug=True
\ No newline at end of file
+    app.run(port=5000, threaded=True)
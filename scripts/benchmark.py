@@ -0,0 +1,270 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from langchain_core.embeddings import Embeddings
+from bm25 import BM25Index
+from indexing import BuildIndex
+from metastore import MetadataStore
+from pipeline import Pipeline
+from retriever import Retriever
+import registry
+import tracing
+
+question_paths = [
+    '../data/raw/Bhagwad_Gita/Bhagwad_Gita_Verses_English_Questions.csv',
+    '../data/raw/Patanjali_Yoga_Sutras/Patanjali_Yoga_Sutras_Verses_English_Questions.csv'
+]
+vector_path = '../data/vectorstore'
+baseline_path = '../data/benchmark/baseline.json'
+
+canned_answer = (
+    "Perform your prescribed duty without attachment to its fruits, for one who acts with a steady mind, "
+    "offering every action to the Supreme, is not bound by the results. Through practice and detachment "
+    "the fluctuations of the mind are stilled, and the seeker comes to know the Self."
+)
+
+#Stand-in for Ollama: fixed latency per call (plus per token when streaming) and canned,
+#deterministic outputs for each kind of prompt the pipeline sends
+class FakeLLM():
+    def __init__(self, latency=0.05, token_latency=0.0, answer=canned_answer):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.answer = answer
+        self.calls = 0
+
+    def respond(self, prompt):
+        if 'either 0 or 1' in prompt:
+            return '1'
+        if 'relevance score' in prompt:
+            return '7'
+        #Rewrite, step-back and decomposition prompts get the original query back
+        match = re.search(r'Original query: (.*)', prompt)
+        if match:
+            return match.group(1).strip()
+        return self.answer
+
+    def __call__(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency)
+        return self.respond(prompt)
+
+    invoke = __call__
+
+    def stream(self, prompt):
+        self.calls += 1
+        time.sleep(self.latency)
+        for word in self.respond(prompt).split(' '):
+            time.sleep(self.token_latency)
+            yield word + ' '
+
+#Deterministic unit vectors derived from the text, for runs without the embedding model.
+#Retrieval quality is meaningless with these, only the timings are.
+class HashEmbeddings(Embeddings):
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+
+    def embed_query(self, text):
+        seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).normal(size=self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+def LoadQuestions(limit=None):
+    questions = pd.concat([pd.read_csv(path, usecols=['question']) for path in question_paths])['question']
+    questions = questions.dropna().astype(str).tolist()
+    return questions[:limit] if limit else questions
+
+#Collects per-call latencies of named stages, from any thread
+class StageTimer():
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    #tracing on_trace hook: the duration of every finished span of a request under its stage
+    #name, and of the whole request as 'total'
+    def record(self, trace, root):
+        for span in trace.finished(root):
+            self.add(span.name, span.duration)
+        self.add('total', root.duration)
+
+    def timed(self, stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        with self._lock:
+            return {
+                stage: {
+                    'count': len(samples),
+                    'mean_ms': float(np.mean(samples) * 1000),
+                    'p50_ms': float(np.percentile(samples, 50) * 1000),
+                    'p95_ms': float(np.percentile(samples, 95) * 1000),
+                    'p99_ms': float(np.percentile(samples, 99) * 1000)
+                }
+                for stage, samples in self.samples.items()
+            }
+
+def PeakRSS():
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+#Per-stage latency percentiles of sequential requests, read from their tracing spans; each
+#question is embedded first, as GetAnswer does when a cache is configured
+def BenchmarkStages(pipeline, questions):
+    timer = StageTimer()
+    tracing.configure(on_trace=timer.record)
+    try:
+        for question in questions:
+            with tracing.trace('request'):
+                pipeline.ComputeAnswer(question, query_embedding=pipeline.EmbedQuery(question))
+    finally:
+        tracing.configure(on_trace=None)
+    return timer.summary()
+
+#First-stage retrieval alone (dense + BM25 + fusion), as Retriever.initialRetrieval runs it
+def BenchmarkRetrieval(questions):
+    vectorstore = registry.get_vectorstore(vector_path)
+    sparse_index = registry.get_sparse_index(vector_path)
+    timer = StageTimer()
+    tracing.configure(on_trace=timer.record)
+    try:
+        for question in questions:
+            embedding = timer.timed('embed', vectorstore.embedding_function.embed_query, question)
+            retriever = Retriever(question, vectorstore, alpha=0.3, sparse_index=sparse_index, query_embedding=embedding)
+            with tracing.trace('initial_retrieval'):
+                retriever.initialRetrieval()
+    finally:
+        tracing.configure(on_trace=None)
+    return timer.summary()
+
+#Answers per second with `concurrency` requests in flight
+def BenchmarkThroughput(pipeline, questions, levels):
+    results = {}
+    for concurrency in levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(pipeline.GetAnswer, questions))
+        elapsed = time.perf_counter() - start
+        results[str(concurrency)] = {'qps': len(questions) / elapsed, 'seconds': elapsed}
+    return results
+
+#What CreateVectorDB does after encoding: index, metadata columns and BM25 postings. The vectors
+#come from the current index so the model is not needed; encoding is timed separately on a sample.
+#Each step runs `repeat` times and the median is reported.
+def BenchmarkBuild(index_type='flat', encode_sample=64, repeat=5):
+    vectorstore = registry.get_vectorstore(vector_path)
+    store = vectorstore.docstore
+    documents = [store.search(vectorstore.index_to_docstore_id[row]) for row in range(vectorstore.index.ntotal)]
+    texts = [doc.page_content for doc in documents]
+    metadatas = [doc.metadata for doc in documents]
+    vectors = vectorstore.index.reconstruct_n(0, vectorstore.index.ntotal)
+    timer = StageTimer()
+    for _ in range(repeat):
+        timer.timed('encode_sample', vectorstore.embedding_function.embed_documents, texts[:encode_sample])
+        with tempfile.TemporaryDirectory() as path:
+            timer.timed('build_index', BuildIndex, vectors, {'type': index_type})
+            timer.timed('write_metadata', MetadataStore.write, path, texts, metadatas)
+            timer.timed('build_bm25', lambda: BM25Index.build(texts).save(path))
+    return {stage: stats['p50_ms'] for stage, stats in timer.summary().items()}
+
+#Metrics where a higher value is worse, with their value in a report
+def Tracked(report):
+    tracked = {}
+    for stage, stats in report['stages'].items():
+        tracked[f"stages.{stage}.p95_ms"] = stats['p95_ms']
+    for stage, stats in report['retrieval'].items():
+        tracked[f"retrieval.{stage}.p95_ms"] = stats['p95_ms']
+    for stage, ms in report['build'].items():
+        tracked[f"build.{stage}_ms"] = ms
+    for concurrency, stats in report['throughput'].items():
+        #Inverted so that higher is worse like the latencies
+        tracked[f"throughput.{concurrency}.ms_per_query"] = 1000 / stats['qps']
+    tracked['peak_rss_mb'] = report['peak_rss_mb']
+    return tracked
+
+#Metrics more than `tolerance` (relative) and `slack` (absolute, ms or MB) worse than the baseline;
+#the slack keeps sub-millisecond stages from failing on timer noise
+def CompareBaseline(report, baseline, tolerance=0.2, slack=2.0):
+    current, previous = Tracked(report), Tracked(baseline)
+    regressions = []
+    for metric, value in current.items():
+        if metric in previous and value > previous[metric] * (1 + tolerance) + slack:
+            regressions.append((metric, previous[metric], value))
+    return regressions
+
+def PrintReport(report):
+    print(f"\n{'stage':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    stages = {**report['stages'], **{f"retrieval.{stage}": stats for stage, stats in report['retrieval'].items()}}
+    for stage, stats in stages.items():
+        print(f"{stage:<20}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+    print(f"\n{'concurrency':<20}{'qps':>10}")
+    for concurrency, stats in report['throughput'].items():
+        print(f"{concurrency:<20}{stats['qps']:>10.2f}")
+    print("\nBuild (ms): " + ", ".join(f"{stage} {ms:.1f}" for stage, ms in report['build'].items()))
+    print(f"Peak RSS: {report['peak_rss_mb']:.0f} MB")
+
+def RunBenchmark(limit=100, latency=0.02, levels=(1, 4, 8), relevance_gate=True, fake_embeddings=False):
+    if fake_embeddings:
+        registry._handles[('embeddings', registry.embedding_model)] = HashEmbeddings()
+        #Hash vectors all score below the gate's threshold, so every question would be rejected
+        relevance_gate = False
+    questions = LoadQuestions(limit)
+    pipeline = Pipeline(FakeLLM(latency=latency), vector_path, relevance_gate=relevance_gate)
+    report = {
+        'config': {'questions': len(questions), 'latency': latency, 'levels': list(levels),
+                   'relevance_gate': relevance_gate, 'fake_embeddings': fake_embeddings},
+        'cold_start': registry.report(),
+        'stages': BenchmarkStages(pipeline, questions),
+        'retrieval': BenchmarkRetrieval(questions),
+        'throughput': BenchmarkThroughput(pipeline, questions, levels),
+        'build': BenchmarkBuild()
+    }
+    report['peak_rss_mb'] = PeakRSS()
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=100, help="Questions to replay, 0 for all")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds per fake LLM call")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help="Concurrency levels for throughput")
+    parser.add_argument('--no-gate', action='store_true', help="Skip the embedding relevance gate")
+    parser.add_argument('--fake-embeddings', action='store_true', help="Hash embeddings instead of the sentence-transformers model, implies --no-gate")
+    parser.add_argument('--baseline', default=baseline_path, help="Baseline report to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown before failing")
+    args = parser.parse_args()
+
+    report = RunBenchmark(limit=args.limit or None, latency=args.latency, levels=args.concurrency,
+                          relevance_gate=not args.no_gate, fake_embeddings=args.fake_embeddings)
+    PrintReport(report)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = CompareBaseline(report, json.load(f), args.tolerance)
+        for metric, before, after in regressions:
+            print(f"REGRESSION {metric}: {before:.3f} -> {after:.3f}")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions against the baseline")
@@ -0,0 +1,214 @@
+import json
+import os
+from collections import Counter
+import numpy as np
+from scipy import sparse
+
+#Files of the sparse index, saved next to index.faiss
+vocab_file = 'bm25_vocab.json'
+indptr_file = 'bm25_indptr.npy'
+postings_file = 'bm25_postings.npy'
+weights_file = 'bm25_weights.npy'
+
+def tokenize(text):
+    return text.split()
+
+#Inverted BM25 index in CSR layout: the postings of term t are
+#postings[indptr[t]:indptr[t+1]] with their precomputed BM25 weights
+class BM25Index():
+    def __init__(self, terms, indptr, postings, weights, n_docs):
+        self.terms = terms
+        self.vocab = {term: i for i, term in enumerate(terms)}
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+        self.n_docs = n_docs
+        self._matrix = None
+
+    #Same scoring and defaults as rank_bm25.BM25Okapi
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75, epsilon=0.25):
+        vocab = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.float64)
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')
+        term_ids = term_ids[order]
+        doc_ids = np.array(doc_ids, dtype=np.int32)[order]
+        tfs = np.array(tfs, dtype=np.float64)[order]
+
+        n_docs = len(texts)
+        df = np.bincount(term_ids, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(df)
+
+        idf = np.log(n_docs - df + 0.5) - np.log(df + 0.5)
+        idf[idf < 0] = epsilon * idf.mean()
+        avgdl = doc_len.mean() if n_docs else 0.0
+        norm = k1 * (1 - b + b * doc_len[doc_ids] / avgdl)
+        weights = (idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)).astype(np.float32)
+
+        return cls(list(vocab), indptr, doc_ids, weights, n_docs)
+
+    #Rebuilds the index from the documents of a LangChain FAISS store, in index order
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        texts = [
+            vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]).page_content
+            for i in range(vectorstore.index.ntotal)
+        ]
+        return cls.build(texts)
+
+    def save(self, path):
+        with open(os.path.join(path, vocab_file), 'w', encoding='utf-8') as f:
+            json.dump({'n_docs': self.n_docs, 'terms': self.terms}, f, ensure_ascii=False)
+        np.save(os.path.join(path, indptr_file), self.indptr)
+        np.save(os.path.join(path, postings_file), self.postings)
+        np.save(os.path.join(path, weights_file), self.weights)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, vocab_file), encoding='utf-8') as f:
+            vocab = json.load(f)
+        mode = 'r' if mmap else None
+        return cls(
+            vocab['terms'],
+            np.load(os.path.join(path, indptr_file), mmap_mode=mode),
+            np.load(os.path.join(path, postings_file), mmap_mode=mode),
+            np.load(os.path.join(path, weights_file), mmap_mode=mode),
+            vocab['n_docs']
+        )
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, vocab_file))
+
+    def _spans(self, tokens):
+        spans = []
+        for token in tokens:
+            term = self.vocab.get(token)
+            if term is not None:
+                spans.append((self.indptr[term], self.indptr[term + 1]))
+        return spans
+
+    #Positions in postings[start:end] of the sorted row ids `rows`. Postings are sorted too, so
+    #the shorter side is binary-searched in the longer one instead of scanning both.
+    def _restrict(self, start, end, rows):
+        postings = self.postings[start:end]
+        if len(rows) < len(postings):
+            positions = np.minimum(np.searchsorted(postings, rows), len(postings) - 1)
+            return positions[postings[positions] == rows]
+        positions = np.minimum(np.searchsorted(rows, postings), len(rows) - 1)
+        return np.flatnonzero(rows[positions] == postings)
+
+    #Row ids and scores of the k best documents, only touching documents that contain a query term.
+    #With `rows` (sorted row ids, see filters.py) only the postings of those rows are read.
+    def top_k(self, tokens, k, rows=None):
+        docs, weights = [], []
+        if rows is not None:
+            rows = np.asarray(rows, dtype=self.postings.dtype)
+        for start, end in self._spans(tokens):
+            if rows is None:
+                docs.append(self.postings[start:end])
+                weights.append(self.weights[start:end])
+            else:
+                positions = start + self._restrict(start, end, rows)
+                docs.append(self.postings[positions])
+                weights.append(self.weights[positions])
+        docs = np.concatenate(docs) if docs else np.empty(0, dtype=np.int64)
+        if len(docs) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        weights = np.concatenate(weights)
+        ids, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights).astype(np.float32)
+        if len(ids) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(ids))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return ids[best].astype(np.int64), scores[best]
+
+    #(terms x docs) matrix over the postings, built on the first batch and reused
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = sparse.csr_matrix(
+                (self.weights, self.postings, self.indptr),
+                shape=(len(self.terms), self.n_docs)
+            )
+        return self._matrix
+
+    #Scores of many queries at once as one sparse (queries x terms) @ (terms x docs) product
+    def batch_scores(self, token_lists):
+        rows, cols = [], []
+        for row, tokens in enumerate(token_lists):
+            for token in tokens:
+                term = self.vocab.get(token)
+                if term is not None:
+                    rows.append(row)
+                    cols.append(term)
+        queries = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(token_lists), len(self.terms))
+        )
+        return (queries @ self.matrix()).tocsr()
+
+    #Row ids and scores of the k best documents for each query. A selection of rows is scored
+    #per query with top_k, which only reads the selected postings.
+    def batch_top_k(self, token_lists, k, rows=None):
+        if rows is not None:
+            return [self.top_k(tokens, k, rows) for tokens in token_lists]
+        scores = self.batch_scores(token_lists)
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            ids, row_scores = scores.indices[start:end], scores.data[start:end]
+            if len(ids) > k:
+                best = np.argpartition(-row_scores, k - 1)[:k]
+            else:
+                best = np.arange(len(ids))
+            best = best[np.lexsort((ids[best], -row_scores[best]))]
+            results.append((ids[best].astype(np.int64), row_scores[best].astype(np.float32)))
+        return results
+
+#Largest difference between the scores of the index and of rank_bm25.BM25Okapi over the same
+#texts, relative to the best score of each query
+def ParityCheck(index, texts, queries):
+    from rank_bm25 import BM25Okapi
+    reference = BM25Okapi([tokenize(text) for text in texts])
+    token_lists = [tokenize(query) for query in queries]
+    scores = index.batch_scores(token_lists).toarray()
+    worst = 0.0
+    for row, tokens in enumerate(token_lists):
+        expected = reference.get_scores(tokens)
+        scale = max(np.abs(expected).max(), 1e-12)
+        worst = max(worst, float(np.abs(scores[row] - expected).max() / scale))
+    return worst
+
+if __name__ == "__main__":
+    import argparse
+    import registry
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='../data/vectorstore')
+    parser.add_argument('--queries', type=int, default=200, help="Rows of the store used as queries")
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    vectorstore = registry.get_vectorstore(args.path)
+    texts = [
+        vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]).page_content
+        for i in range(vectorstore.index.ntotal)
+    ]
+    rows = np.random.default_rng(0).permutation(len(texts))[:args.queries]
+    difference = ParityCheck(registry.get_sparse_index(args.path), texts, [texts[row] for row in rows])
+    print(f"Largest relative score difference to rank_bm25: {difference:.2e}")
+    if difference > args.tolerance:
+        raise SystemExit(f"BM25 scores differ from rank_bm25 by more than {args.tolerance}")
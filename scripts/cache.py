@@ -0,0 +1,213 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+#Answer cache keyed on query embeddings: a lookup hits when a cached query is
+#at least `threshold` cosine-similar to the new one. Entries are evicted
+#least-recently-used first once `max_entries` is reached, and expire after `ttl` seconds.
+#With a database, the last use of hit entries is written once `flush_every` entries were hit or
+#at least every `flush_interval` seconds rather than on every hit.
+class SemanticCache():
+    def __init__(self, threshold=0.92, max_entries=1024, ttl=24 * 3600, path=None, flush_every=64, flush_interval=30.0):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        #slot -> (key, query, answer, created); the slot is the row of the entry in self._vectors
+        self._entries = OrderedDict()
+        self._vectors = None
+        self._used = np.zeros(max_entries, dtype=bool)
+        self._created = np.zeros(max_entries, dtype=np.float64)
+        #key -> last use of the entries hit since the last write
+        self._touched = {}
+        self._flushed = time.time()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key INTEGER PRIMARY KEY AUTOINCREMENT, query TEXT, embedding BLOB, answer TEXT, created REAL, last_used REAL)"
+            )
+            self._db.commit()
+            self._restore()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _restore(self):
+        now = time.time()
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+            self._db.commit()
+        rows = self._db.execute(
+            "SELECT key, query, embedding, answer, created FROM cache ORDER BY last_used DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        for key, query, embedding, answer, created in reversed(rows):
+            self._insert(key, query, np.frombuffer(embedding, dtype=np.float32), json.loads(answer), created)
+
+    def _insert(self, key, query, vector, answer, created):
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+        if len(self._entries) >= self.max_entries:
+            self._evict([next(iter(self._entries))])
+        slot = int(np.flatnonzero(~self._used)[0])
+        self._vectors[slot] = vector
+        self._used[slot] = True
+        self._created[slot] = created
+        self._entries[slot] = (key, query, answer, created)
+
+    def _evict(self, slots):
+        keys = []
+        for slot in slots:
+            key = self._entries.pop(int(slot))[0]
+            self._used[slot] = False
+            self._touched.pop(key, None)
+            keys.append((key,))
+        if self._db is not None:
+            self._db.executemany("DELETE FROM cache WHERE key = ?", keys)
+            self._db.commit()
+
+    #Pending last_used updates, committed by the caller
+    def _write_touched(self, now):
+        if self._touched:
+            self._db.executemany("UPDATE cache SET last_used = ? WHERE key = ?", [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+        self._flushed = now
+
+    def _touch(self, key, now):
+        if self._db is None:
+            return
+        self._touched[key] = now
+        if len(self._touched) >= self.flush_every or now - self._flushed >= self.flush_interval:
+            self._write_touched(now)
+            self._db.commit()
+
+    #Writes the last use of recent hits, e.g. before shutting down
+    def flush(self):
+        if self._db is None:
+            return
+        with self._lock:
+            self._write_touched(time.time())
+            self._db.commit()
+
+    #Drops every entry, e.g. when the store the answers were retrieved from changes
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._used[:] = False
+            self._touched.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache")
+                self._db.commit()
+
+    def get(self, embedding):
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            #Expired entries are dropped first, so only live ones are searched
+            if self._entries and self.ttl is not None:
+                expired = np.flatnonzero(self._used & (self._created < now - self.ttl))
+                if len(expired):
+                    self._evict(expired)
+            if self._entries:
+                slots = np.flatnonzero(self._used)
+                similarities = self._vectors[slots] @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    slot = int(slots[best])
+                    key, _, answer, _ = self._entries[slot]
+                    self._entries.move_to_end(slot)
+                    self._touch(key, now)
+                    self.hits += 1
+                    return answer
+            self.misses += 1
+            return None
+
+    def put(self, query, embedding, answer):
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            key = None
+            if self._db is not None:
+                key = self._db.execute(
+                    "INSERT INTO cache (query, embedding, answer, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (query, vector.tobytes(), json.dumps(answer), now, now)
+                ).lastrowid
+                self._write_touched(now)
+                self._db.commit()
+            self._insert(key, query, vector, answer, now)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries)
+            }
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+#Persistent embeddings keyed by (model name, content hash of the embedded text), so a
+#rebuild or incremental update only encodes texts the model has not seen before
+class EmbeddingCache():
+    def __init__(self, path, model_name):
+        self.model_name = model_name
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))"
+        )
+        self._db.commit()
+
+    #hash -> vector for the hashes that are cached
+    def get_many(self, hashes, batch_size=500):
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        for start in range(0, len(hashes), batch_size):
+            batch = hashes[start:start + batch_size]
+            rows = self._db.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                [self.model_name] + batch
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, hashes, vectors):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+            [(self.model_name, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(hashes, vectors)]
+        )
+        self._db.commit()
+
+    #Embeddings of texts in order, encoding only the ones missing from the cache
+    def embed(self, texts, encode):
+        hashes = [content_hash(text) for text in texts]
+        found = self.get_many(hashes)
+        missing = list(dict.fromkeys(key for key in hashes if key not in found))
+        hits = sum(key in found for key in hashes)
+        if missing:
+            text_by_hash = dict(zip(hashes, texts))
+            vectors = encode([text_by_hash[key] for key in missing])
+            self.put_many(missing, vectors)
+            found.update(zip(missing, np.asarray(vectors, dtype=np.float32)))
+        print(f"Embedding cache: {hits} hits, {len(missing)} encoded")
+        return np.stack([found[key] for key in hashes])
+
+    def close(self):
+        self._db.close()
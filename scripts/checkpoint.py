@@ -0,0 +1,30 @@
+import json
+import os
+import threading
+
+#Results appended as JSON lines as they finish, so an interrupted run resumes where it stopped.
+#Each result is a dict with a 'key'; the first line can be a header recording what the results
+#depend on (e.g. the retrieval config), which is skipped on load.
+class Checkpoint():
+    def __init__(self, path, header=None):
+        self.path = path
+        self.header = header
+        self._lock = threading.Lock()
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        if 'key' in result:
+                            self.results[result['key']] = result
+
+    def add(self, result):
+        with self._lock:
+            self.results[result['key']] = result
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            new = not os.path.exists(self.path)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                if new and self.header is not None:
+                    f.write(json.dumps({'config': self.header}) + "\n")
+                f.write(json.dumps(result) + "\n")
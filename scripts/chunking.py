@@ -1,23 +1,11 @@
 import pandas as pd
 
-# Read the processed data
-data = pd.read_csv('../data/processed/final.csv')
+#Chunks written by ingest.py: one row per question with the metadata of its verse
+chunks_path = '../data/processed/chunks.parquet'
+text_column = 'question'
+metadata_columns = ['speaker', 'shloka', 'chapter', 'verse', 'source', 'translations', 'purport']
 
-#Chunking the whole dataset verse-wise
-def chunking(): 
-    chunks = []
-    for i in range(len(data)):   
-        row = data.iloc[i]
-        cluster_content = {
-            "chapter": row['chapter'],
-            "verse": row['verse'],
-            "source": row['Source'],
-            "sanskrit": row['sanskrit'],
-            "translations": row['translation'],
-            "speakers": row['speaker'],
-            "questions": row['question'],
-            "purports": row['purport']
-        }
-        chunks.append(cluster_content)
-    
-    return chunks
\ No newline at end of file
+#Chunking the whole dataset verse-wise: the texts to embed and their metadata, read column-wise
+def chunking(path=chunks_path):
+    data = pd.read_parquet(path, columns=[text_column] + metadata_columns)
+    return data[text_column].tolist(), data[metadata_columns].to_dict('records')
@@ -1,15 +1,18 @@
-import pandas as pd
-import numpy as np
+#Mapping table from the speaker names of the raw verses to the names kept in the metadata
+speaker_map = {
+    'सञ्जय': 'Sanjay',
+    'संजय': 'Sanjay',
+    'धृतराष्ट्र': 'Dhritrashtra',
+    'भगवान': 'Bhagwan',
+    'अर्जुन': 'Arjun'
+}
+#The Yoga Sutra verses have no speaker
+default_speaker = 'Patanjali'
 
-data = pd.read_csv("../data/processed/clustered5.csv")
-
-# Replace NaN values in the 'speaker' column with 'Patanjali'
-data['speaker'] = data['speaker'].replace(np.nan, 'Patanjali')
-data['speaker'] = data['speaker'].replace('सञ्जय', 'Sanjay')
-data['speaker'] = data['speaker'].replace('धृतराष्ट्र', 'Dhritrashtra')
-data['speaker'] = data['speaker'].replace('संजय', 'Sanjay')
-data['speaker'] = data['speaker'].replace('भगवान', 'Bhagwan')
-data['speaker'] = data['speaker'].replace('अर्जुन', 'Arjun')
-
-print(data['speaker'])
-data.to_csv("../data/processed/final.csv")
\ No newline at end of file
+#One lookup in the mapping table for the whole column instead of a replace pass per name;
+#names missing from the table are kept as they are
+def clean_speakers(speakers):
+    speakers = speakers.astype(object).str.strip()
+    mapped = speakers.map(speaker_map)
+    mapped = mapped.where(mapped.notna(), speakers)
+    return mapped.where(mapped.notna(), default_speaker)
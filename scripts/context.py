@@ -0,0 +1,59 @@
+#Rough Llama token count without loading a tokenizer: about 4 characters or 3/4 of a word per token,
+#whichever is larger, so transliterated Sanskrit is not undercounted
+def estimate_tokens(text):
+    return max(len(text) // 4, len(text.split()) * 4 // 3)
+
+#Cuts text to about max_tokens at a word boundary
+def truncate_tokens(text, max_tokens, count_tokens=estimate_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle])) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]) + " ..."
+
+def verse_id(metadata):
+    return f"{metadata.get('source', 'N/A')} {metadata.get('chapter', '?')}.{metadata.get('verse', '?')}"
+
+#Picks the passages of the generation prompt. Documents arrive best first; duplicates of a verse are
+#dropped, each purport is cut to passage_tokens, and passages are added in rank order while they fit
+#in budget tokens (a passage that does not fit is skipped for the smaller ones after it).
+class ContextBuilder():
+    def __init__(self, budget=1500, passage_tokens=300, count_tokens=estimate_tokens):
+        self.budget = budget
+        self.passage_tokens = passage_tokens
+        self.count_tokens = count_tokens
+
+    def passage(self, document):
+        metadata = document.metadata
+        speaker = metadata.get('speaker', 'Unknown')
+        return {
+            'id': verse_id(metadata),
+            'speaker': ", ".join(speaker) if isinstance(speaker, list) else str(speaker),
+            'shloka': str(metadata.get('shloka', 'N/A')),
+            'purport': truncate_tokens(str(metadata.get('purport', 'N/A')), self.passage_tokens, self.count_tokens),
+            'question': document.page_content
+        }
+
+    #Selected passages in rank order and the token count of the context they make up
+    def build(self, documents):
+        seen = set()
+        passages = []
+        used = 0
+        for document in documents:
+            passage = self.passage(document)
+            key = (passage['id'], passage['purport'])
+            if key in seen:
+                continue
+            seen.add(key)
+            cost = self.count_tokens(passage['purport']) + self.count_tokens(passage['shloka']) + self.count_tokens(passage['id'])
+            if used + cost > self.budget:
+                continue
+            passages.append(passage)
+            used += cost
+        return passages, used
@@ -0,0 +1,106 @@
+import json
+import os
+import numpy as np
+
+#Files of the filter index, saved next to index.faiss
+values_file = 'filter_values.json'
+indptr_file = 'filter_{}_indptr.npy'
+rows_file = 'filter_{}_rows.npy'
+
+#Metadata fields retrieval can be restricted to
+filter_fields = ('source', 'chapter', 'verse', 'speaker')
+
+#Values are matched as lower-cased strings, so {"chapter": 2} and {"speaker": "bhagwan"} work
+def filter_key(value):
+    return str(value).strip().lower()
+
+def valid_value(value):
+    return isinstance(value, str) or (isinstance(value, int) and not isinstance(value, bool))
+
+#Raises ValueError unless filters maps known fields to a string/integer or a list of them;
+#other values (floats, booleans, objects) would never match and silently return nothing
+def check_filters(filters, fields=filter_fields):
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(filters) - set(fields)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {sorted(unknown)}, expected some of {list(fields)}")
+    for field, wanted in filters.items():
+        values = wanted if isinstance(wanted, (list, tuple)) else [wanted]
+        if not all(valid_value(value) for value in values):
+            raise ValueError(f"Filter {field} must be a string, an integer or a list of them, got {wanted!r}")
+
+#Row ids of each value of each field in CSR layout: the rows where field == values[field][v]
+#are rows[field][indptr[field][v]:indptr[field][v+1]], sorted
+class FilterIndex():
+    def __init__(self, values, indptr, rows, n_rows):
+        self.values = values
+        self.value_ids = {field: {value: i for i, value in enumerate(field_values)} for field, field_values in values.items()}
+        self.indptr = indptr
+        self.rows = rows
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, metadatas, fields=filter_fields):
+        values, indptr, rows = {}, {}, {}
+        for field in fields:
+            keys = [filter_key(metadata.get(field, '')) for metadata in metadatas]
+            values[field], inverse = np.unique(np.array(keys, dtype=object), return_inverse=True)
+            values[field] = [str(value) for value in values[field]]
+            #Stable sort keeps the rows of each value in ascending order
+            rows[field] = np.argsort(inverse, kind='stable').astype(np.int64)
+            indptr[field] = np.zeros(len(values[field]) + 1, dtype=np.int64)
+            indptr[field][1:] = np.cumsum(np.bincount(inverse, minlength=len(values[field])))
+        return cls(values, indptr, rows, len(metadatas))
+
+    #Rebuilds the index from the documents of a LangChain FAISS store, in index order
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        return cls.build([
+            vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]).metadata
+            for i in range(vectorstore.index.ntotal)
+        ])
+
+    def save(self, path):
+        with open(os.path.join(path, values_file), 'w', encoding='utf-8') as f:
+            json.dump({'n_rows': self.n_rows, 'values': self.values}, f, ensure_ascii=False)
+        for field in self.values:
+            np.save(os.path.join(path, indptr_file.format(field)), self.indptr[field])
+            np.save(os.path.join(path, rows_file.format(field)), self.rows[field])
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, values_file), encoding='utf-8') as f:
+            info = json.load(f)
+        mode = 'r' if mmap else None
+        return cls(
+            info['values'],
+            {field: np.load(os.path.join(path, indptr_file.format(field)), mmap_mode=mode) for field in info['values']},
+            {field: np.load(os.path.join(path, rows_file.format(field)), mmap_mode=mode) for field in info['values']},
+            info['n_rows']
+        )
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, values_file))
+
+    #Sorted row ids matching every field of `filters`, e.g. {"source": "Gita", "chapter": [2, 3]};
+    #a list matches any of its values. None when there is nothing to filter on.
+    def select(self, filters):
+        if not filters:
+            return None
+        check_filters(filters, self.values)
+        selection = None
+        for field, wanted in filters.items():
+            if not isinstance(wanted, (list, tuple)):
+                wanted = [wanted]
+            spans = []
+            for value in wanted:
+                value_id = self.value_ids[field].get(filter_key(value))
+                if value_id is not None:
+                    spans.append(self.rows[field][self.indptr[field][value_id]:self.indptr[field][value_id + 1]])
+            rows = np.unique(np.concatenate(spans)) if spans else np.empty(0, dtype=np.int64)
+            selection = rows if selection is None else np.intersect1d(selection, rows, assume_unique=True)
+            if len(selection) == 0:
+                break
+        return selection.astype(np.int64)
@@ -0,0 +1,58 @@
+import numpy as np
+
+def min_max(scores):
+    if len(scores) == 0:
+        return scores
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+#Joins the dense and sparse candidate lists by row id and blends their scores
+class HybridFusion():
+    def __init__(self, method='alpha', alpha=0.5, rrf_k=60):
+        if method not in ('alpha', 'rrf'):
+            raise ValueError(f"Unknown fusion method: {method}")
+        self.method = method
+        self.alpha = alpha
+        self.rrf_k = rrf_k
+
+    #dense_distances are L2 distances (lower is better), sparse_scores are BM25 scores (higher is better)
+    def fuse(self, dense_ids, dense_distances, sparse_ids, sparse_scores, k):
+        dense_ids = np.asarray(dense_ids, dtype=np.int64)
+        sparse_ids = np.asarray(sparse_ids, dtype=np.int64)
+        ids = np.union1d(dense_ids, sparse_ids)
+        if len(ids) == 0:
+            return ids, np.empty(0, dtype=np.float32)
+
+        dense_pos = np.searchsorted(ids, dense_ids)
+        sparse_pos = np.searchsorted(ids, sparse_ids)
+        dense = np.zeros(len(ids), dtype=np.float32)
+        sparse = np.zeros(len(ids), dtype=np.float32)
+
+        if self.method == 'alpha':
+            #A document missing from one side scores like the worst candidate of that side
+            dense[dense_pos] = 1 - min_max(np.asarray(dense_distances, dtype=np.float32))
+            sparse[sparse_pos] = min_max(np.asarray(sparse_scores, dtype=np.float32))
+            combined = self.alpha * dense + (1 - self.alpha) * sparse
+        else:
+            #Candidate lists are already sorted, so rank is the position in the list
+            dense[dense_pos] = 1 / (self.rrf_k + np.arange(1, len(dense_ids) + 1))
+            sparse[sparse_pos] = 1 / (self.rrf_k + np.arange(1, len(sparse_ids) + 1))
+            combined = dense + sparse
+
+        order = np.argsort(-combined, kind='stable')[:k]
+        return ids[order], combined[order]
+
+#Reciprocal-rank fusion of several ranked id lists (e.g. one per query variant),
+#de-duplicated by row id. Returns the k best ids and their fused scores.
+def rank_merge(id_lists, k, rrf_k=60):
+    id_lists = [np.asarray(ids, dtype=np.int64) for ids in id_lists if len(ids)]
+    if not id_lists:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    ids = np.concatenate(id_lists)
+    scores = np.concatenate([1 / (rrf_k + np.arange(1, len(ranked) + 1)) for ranked in id_lists])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    fused = np.bincount(inverse, weights=scores).astype(np.float32)
+    order = np.argsort(-fused, kind='stable')[:k]
+    return unique_ids[order], fused[order]
@@ -0,0 +1,146 @@
+import json
+import os
+import re
+import time
+import numpy as np
+
+#Files of the verse graph, converted once from knowledge_graph.pkl
+graph_path = '../data/graphs'
+pickle_file = 'knowledge_graph.pkl'
+nodes_file = 'graph_nodes.json'
+indptr_file = 'graph_indptr.npy'
+neighbors_file = 'graph_neighbors.npy'
+relations_file = 'graph_relations.npy'
+
+#Graph nodes are Gita verses named like chapter-2-verse-47
+node_pattern = re.compile(r'^chapter-(\d+)-verse-(\d+)$')
+graph_source = 'Gita'
+
+def parse_node(name):
+    match = node_pattern.match(name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+#Undirected verse graph in CSR layout: the neighbours of node n are
+#neighbors[indptr[n]:indptr[n+1]], with the relation of each edge alongside
+class KnowledgeGraph():
+    def __init__(self, nodes, relation_names, indptr, neighbors, relations):
+        self.nodes = nodes
+        self.relation_names = relation_names
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.relations = relations
+        self.node_ids = {}
+        for node, name in enumerate(nodes):
+            key = parse_node(name)
+            if key is not None:
+                self.node_ids[key] = node
+        #node -> first vector store row of its verse, set by attach()
+        self.node_rows = np.full(len(nodes), -1, dtype=np.int64)
+
+    @classmethod
+    def from_networkx(cls, graph):
+        nodes = [str(node) for node in graph.nodes()]
+        index = {node: i for i, node in enumerate(graph.nodes())}
+        relation_names = sorted({str(data.get('relation', '')) for _, _, data in graph.edges(data=True)})
+        relation_ids = {name: i for i, name in enumerate(relation_names)}
+
+        sources, targets, relations = [], [], []
+        for u, v, data in graph.edges(data=True):
+            relation = relation_ids[str(data.get('relation', ''))]
+            sources += [index[u], index[v]]
+            targets += [index[v], index[u]]
+            relations += [relation, relation]
+        sources = np.array(sources, dtype=np.int64)
+        order = np.lexsort((np.array(targets, dtype=np.int64), sources))
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(nodes)))
+        return cls(
+            nodes,
+            relation_names,
+            indptr,
+            np.array(targets, dtype=np.int32)[order],
+            np.array(relations, dtype=np.int8)[order]
+        )
+
+    #The pickle is a networkx graph, so networkx is only needed for this conversion
+    @classmethod
+    def from_pickle(cls, path):
+        import pickle
+        with open(os.path.join(path, pickle_file), 'rb') as f:
+            return cls.from_networkx(pickle.load(f))
+
+    def save(self, path):
+        with open(os.path.join(path, nodes_file), 'w', encoding='utf-8') as f:
+            json.dump({'nodes': self.nodes, 'relations': self.relation_names}, f)
+        np.save(os.path.join(path, indptr_file), self.indptr)
+        np.save(os.path.join(path, neighbors_file), self.neighbors)
+        np.save(os.path.join(path, relations_file), self.relations)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, nodes_file), encoding='utf-8') as f:
+            info = json.load(f)
+        mode = 'r' if mmap else None
+        return cls(
+            info['nodes'],
+            info['relations'],
+            np.load(os.path.join(path, indptr_file), mmap_mode=mode),
+            np.load(os.path.join(path, neighbors_file), mmap_mode=mode),
+            np.load(os.path.join(path, relations_file), mmap_mode=mode)
+        )
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, nodes_file))
+
+    #Links the nodes to the rows of a vector store; verses without a row stay at -1
+    def attach(self, vectorstore):
+        self.node_rows[:] = -1
+        for row in range(vectorstore.index.ntotal):
+            document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[row])
+            node = self.node_of(document.metadata)
+            if node is not None and self.node_rows[node] < 0:
+                self.node_rows[node] = row
+        return self
+
+    def node_of(self, metadata):
+        if metadata.get('source') != graph_source:
+            return None
+        try:
+            return self.node_ids.get((int(metadata['chapter']), int(metadata['verse'])))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    #Rows of verses linked to the retrieved documents as (rank of the document it was reached
+    #from, row) pairs, breadth-first from the best ranked document, skipping verses already
+    #retrieved. Stops at max_new rows, max_hops hops or when time_budget seconds are spent,
+    #whichever comes first.
+    def expand(self, documents, max_new=3, max_hops=1, time_budget=0.002):
+        deadline = time.perf_counter() + time_budget
+        frontier = [(node, rank) for rank, node in enumerate(self.node_of(doc.metadata) for doc in documents) if node is not None]
+        seen = {node for node, _ in frontier}
+        rows = []
+        for _ in range(max_hops):
+            next_frontier = []
+            for node, rank in frontier:
+                for neighbor in self.neighbors[self.indptr[node]:self.indptr[node + 1]]:
+                    neighbor = int(neighbor)
+                    if neighbor in seen:
+                        continue
+                    seen.add(neighbor)
+                    next_frontier.append((neighbor, rank))
+                    if self.node_rows[neighbor] >= 0:
+                        rows.append((rank, int(self.node_rows[neighbor])))
+                        if len(rows) >= max_new:
+                            return rows
+                if time.perf_counter() > deadline:
+                    return rows
+            frontier = next_frontier
+        return rows
+
+#Converts knowledge_graph.pkl into the CSR files read at startup
+if __name__ == "__main__":
+    KnowledgeGraph.from_pickle(graph_path).save(graph_path)
+    print("Knowledge graph converted")
@@ -0,0 +1,115 @@
+import time
+import faiss
+import numpy as np
+
+#Index types CreateVectorDB can build:
+#  flat  - exact L2 search over float32 vectors (the original index)
+#  ip    - exact inner product over L2-normalized vectors (cosine similarity)
+#  hnsw  - HNSW graph over float32 vectors
+#  sq8   - exact L2 search over int8 scalar-quantized vectors (4x smaller)
+#  ivfpq - inverted lists with product-quantized codes (smallest, approximate)
+index_types = ('flat', 'ip', 'hnsw', 'sq8', 'ivfpq')
+
+default_index_config = {
+    'type': 'flat',
+    'hnsw_m': 32,
+    'hnsw_ef_construction': 200,
+    'hnsw_ef_search': 64,
+    'ivf_nlist': 64,
+    'ivf_nprobe': 8,
+    'pq_m': 48,
+    'pq_bits': 8
+}
+
+def normalize(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32).copy()
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def uses_inner_product(index):
+    return index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+#Index type of a built index, e.g. for a store written before the type was recorded
+def index_type(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return 'sq8'
+    if isinstance(index, faiss.IndexFlat):
+        return 'ip' if uses_inner_product(index) else 'flat'
+    raise ValueError(f"Unknown index class: {index.__class__.__name__}")
+
+#Index types whose remove_ids() shifts the remaining vectors down, keeping row ids positional
+removable_types = ('flat', 'ip', 'sq8')
+
+def BuildIndex(embeddings, config=None):
+    config = {**default_index_config, **(config or {})}
+    index_type = config['type']
+    if index_type not in index_types:
+        raise ValueError(f"Unknown index type: {index_type}, expected one of {index_types}")
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n, dimension = embeddings.shape
+
+    if index_type == 'flat':
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == 'ip':
+        index = faiss.IndexFlatIP(dimension)
+        embeddings = normalize(embeddings)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, config['hnsw_m'])
+        index.hnsw.efConstruction = config['hnsw_ef_construction']
+        index.hnsw.efSearch = config['hnsw_ef_search']
+    elif index_type == 'sq8':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+        index.train(embeddings)
+    else:
+        #faiss wants ~39 training points per list and at least 2^bits points for the codebooks
+        nlist = max(1, min(config['ivf_nlist'], n // 39))
+        bits = min(config['pq_bits'], int(np.log2(max(n, 2))))
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, config['pq_m'], bits)
+        index.train(embeddings)
+        index.nprobe = min(config['ivf_nprobe'], nlist)
+        #Keeps reconstruct() working, e.g. for the relevance gate
+        index.make_direct_map()
+
+    index.add(embeddings)
+    return index
+
+#Recall@k against the exact flat index, mean search latency and serialized size for each index type
+def IndexReport(embeddings, queries, k=10, configs=None):
+    configs = configs or [{'type': index_type} for index_type in index_types]
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    exact = BuildIndex(embeddings, {'type': 'flat'})
+    _, truth = exact.search(queries, k)
+
+    report = []
+    for config in configs:
+        start = time.perf_counter()
+        index = BuildIndex(embeddings, config)
+        build_seconds = time.perf_counter() - start
+
+        search_queries = normalize(queries) if uses_inner_product(index) else queries
+        start = time.perf_counter()
+        for query in search_queries:
+            _, ids = index.search(query[None, :], k)
+        latency_ms = (time.perf_counter() - start) / len(queries) * 1000
+        _, ids = index.search(search_queries, k)
+
+        recall = np.mean([len(set(found) & set(expected)) / k for found, expected in zip(ids, truth)])
+        report.append({
+            'type': config['type'],
+            'recall@k': float(recall),
+            'latency_ms': latency_ms,
+            'build_s': build_seconds,
+            'size_bytes': int(faiss.serialize_index(index).nbytes)
+        })
+    return report
+
+def PrintIndexReport(report):
+    print(f"{'type':<8}{'recall@k':>10}{'latency ms':>12}{'build s':>10}{'size KB':>10}")
+    for row in report:
+        print(f"{row['type']:<8}{row['recall@k']:>10.3f}{row['latency_ms']:>12.3f}{row['build_s']:>10.2f}{row['size_bytes'] / 1024:>10.0f}")
@@ -0,0 +1,144 @@
+import argparse
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cleaning import clean_speakers
+from chunking import chunks_path, text_column, metadata_columns
+
+#Raw question CSVs and the source name their verses get in the metadata
+raw_sources = [
+    ('Gita', '../data/raw/Bhagwad_Gita/Bhagwad_Gita_Verses_English_Questions.csv'),
+    ('YogaSutra', '../data/raw/Patanjali_Yoga_Sutras/Patanjali_Yoga_Sutras_Verses_English_Questions.csv')
+]
+#Typed intermediates between the stages
+verses_path = '../data/processed/verses.parquet'
+purports_path = '../data/processed/purports.parquet'
+#Only the Gita has purports to scrape
+purport_source = 'Gita'
+#Rows read from a CSV or Parquet file at a time, and written as one Parquet row group
+chunk_rows = 10000
+
+verse_schema = pa.schema([
+    ('source', pa.string()),
+    ('chapter', pa.int64()),
+    ('verse', pa.int64()),
+    ('speaker', pa.string()),
+    ('sanskrit', pa.string()),
+    ('translation', pa.string()),
+    ('question', pa.string())
+])
+purport_schema = pa.schema([
+    ('source', pa.string()),
+    ('chapter', pa.int64()),
+    ('verse', pa.int64()),
+    ('purport', pa.string())
+])
+chunk_types = {'chapter': pa.int64(), 'verse': pa.int64()}
+chunk_schema = pa.schema([(column, chunk_types.get(column, pa.string())) for column in [text_column] + metadata_columns])
+
+#An output is up to date when it is newer than all of its inputs
+def up_to_date(output, inputs):
+    return os.path.exists(output) and all(os.path.getmtime(output) >= os.path.getmtime(path) for path in inputs)
+
+#Writes the frames one row group each, through a temporary file so a failed run keeps the old output
+def write_parquet(path, schema, frames):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows = 0
+    with pq.ParquetWriter(path + '.tmp', schema) as writer:
+        for frame in frames:
+            writer.write_table(pa.Table.from_pandas(frame[schema.names], schema=schema, preserve_index=False))
+            rows += len(frame)
+    os.replace(path + '.tmp', path)
+    return rows
+
+def read_parquet(path, columns=None):
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+        yield batch.to_pandas()
+
+#One row per question: a question cell holds all the questions of its verse, each ending with '?'
+def split_questions(frame):
+    frame = frame.assign(question=frame['question'].fillna('').astype(str).str.split(r'(?<=\?)\s*')).explode('question')
+    frame['question'] = frame['question'].str.strip()
+    return frame[frame['question'] != '']
+
+def read_verses(source, path):
+    for frame in pd.read_csv(path, chunksize=chunk_rows):
+        frame = frame.rename(columns=str.strip)
+        frame['source'] = source
+        frame['speaker'] = clean_speakers(frame['speaker'] if 'speaker' in frame else pd.Series(None, index=frame.index, dtype=object))
+        yield split_questions(frame)
+
+#Raw CSVs -> verses.parquet: cleaned speakers, one row per question
+def VerseStage():
+    frames = (frame for source, path in raw_sources for frame in read_verses(source, path))
+    return write_parquet(verses_path, verse_schema, frames)
+
+def LoadPurports():
+    if os.path.exists(purports_path):
+        return pd.read_parquet(purports_path)
+    return purport_schema.empty_table().to_pandas()
+
+#Scrapes the purports of verses that have none yet into purports.parquet; only new verses are
+#requested, so a grown corpus only costs the requests of its new verses
+def PurportStage(scraper):
+    from scrapper import scrape_purports
+    verses = pd.concat(
+        frame[frame['source'] == purport_source].drop_duplicates()
+        for frame in read_parquet(verses_path, columns=['source', 'chapter', 'verse'])
+    ).drop_duplicates()
+    known = LoadPurports()
+    missing = verses.merge(known[['source', 'chapter', 'verse']], how='left', indicator=True)
+    missing = missing[missing['_merge'] == 'left_only']
+    if missing.empty:
+        return 0
+    scraped = scrape_purports(missing, scraper).assign(source=purport_source)
+    if scraped.empty:
+        return 0
+    write_parquet(purports_path, purport_schema, [pd.concat([known, scraped], ignore_index=True)])
+    return len(scraped)
+
+#verses.parquet + purports.parquet -> chunks.parquet in the layout of the vector store metadata;
+#verses without a purport keep their translation
+def ChunkStage():
+    purports = LoadPurports()
+
+    def frames():
+        for frame in read_parquet(verses_path):
+            frame = frame.merge(purports, on=['source', 'chapter', 'verse'], how='left')
+            frame['purport'] = frame['purport'].fillna(frame['translation'])
+            yield frame.rename(columns={'sanskrit': 'shloka', 'translation': 'translations'})
+
+    return write_parquet(chunks_path, chunk_schema, frames())
+
+#Runs the stages whose output is missing or older than their inputs (all of them with force).
+#Without a scraper the purports found so far are used.
+def Ingest(scraper=None, force=False):
+    start = time.perf_counter()
+    if force or not up_to_date(verses_path, [path for _, path in raw_sources]):
+        stage = time.perf_counter()
+        print(f"Verses: {VerseStage()} rows in {time.perf_counter() - stage:.2f}s")
+    if scraper is not None:
+        stage = time.perf_counter()
+        print(f"Purports: {PurportStage(scraper)} verses scraped in {time.perf_counter() - stage:.2f}s")
+    inputs = [verses_path] + ([purports_path] if os.path.exists(purports_path) else [])
+    if force or not up_to_date(chunks_path, inputs):
+        stage = time.perf_counter()
+        print(f"Chunks: {ChunkStage()} rows in {time.perf_counter() - stage:.2f}s")
+    print(f"Data prep done in {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+    from scrapper import Scraper, base_url, cache_path
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help="Rerun every stage even when its output is up to date")
+    parser.add_argument('--no-scrape', action='store_true', help="Use the purports scraped so far without requesting new ones")
+    parser.add_argument('--base-url', default=base_url, help="Site to scrape, e.g. a local stub server")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+    parser.add_argument('--rate', type=float, default=4, help="Requests per second")
+    parser.add_argument('--cache-dir', default=cache_path, help="Directory of cached responses")
+    args = parser.parse_args()
+
+    scraper = None if args.no_scrape else Scraper(base_url=args.base_url, concurrency=args.concurrency, rate=args.rate, cache_dir=args.cache_dir)
+    Ingest(scraper=scraper, force=args.force)
@@ -1,29 +1,47 @@
+import itertools
 import streamlit as st
 from pipeline import Pipeline
+from cache import SemanticCache
 from langchain_community.llms import Ollama
 
 retrieval_vector_store = "../data/vectorstore"
-helperPath = "../data/helperData"
 
-llm = Ollama(base_url='http://localhost:11434', model = 'llama3.2')
-
-pipeline = Pipeline(path_vectorstore=retrieval_vector_store, llm=llm)
+#Streamlit reruns this script on every interaction, so the pipeline is built once per process
+@st.cache_resource
+def LoadPipeline():
+    llm = Ollama(base_url='http://localhost:11434', model = 'llama3.2')
+    return Pipeline(path_vectorstore=retrieval_vector_store, llm=llm, cache=SemanticCache())
 
 # Set page configuration
 st.set_page_config(page_title="SAMAY", layout="centered")
 
+pipeline = LoadPipeline()
+
 # App title
 st.title("📖 SAMAY - Spiritual Assistance and Meditation Aid for You")
 
+def RenderSources(event):
+    with st.expander("Sources", expanded=False):
+        for speaker, shloka in zip(event['metadata_speakers'], event['shlokas']):
+            st.markdown(f"**{speaker}**: {shloka}")
+
+#Shows the sources as soon as retrieval is done, then streams the answer tokens below them
+def RenderAnswer(events):
+    first = next(events)
+    if first['type'] == 'metadata':
+        RenderSources(first)
+    else:
+        events = itertools.chain([first], events)
+    st.write_stream(event['text'] for event in events if event['type'] == 'token')
+
 # Input box for user query
 query = st.text_input("Enter your query:", placeholder="Ask a question about Sankhya Yoga, Karma Yoga, etc.")
 
 # Button to get the answer
 if st.button("Get Answer"):
     if query.strip():
-        # Call the GetAnswer function
-        answers = pipeline.GetAnswer(query=query)
-        st.write(answers)
+        # Stream the answer, showing the retrieved sources before the text arrives
+        RenderAnswer(pipeline.StreamAnswer(query=query))
     else:
         st.error("Please enter a query before submitting.")
 
@@ -0,0 +1,111 @@
+import json
+import os
+import numpy as np
+from langchain.docstore.document import Document
+
+#Directory of the columnar metadata, next to index.faiss
+metadata_dir = 'metadata'
+columns_file = 'columns.json'
+text_column = 'page_content'
+
+#Document texts and metadata stored column by column. Integer columns (chapter, verse) are
+#plain int64 arrays; text columns are one UTF-8 blob plus an offsets array, so row i is
+#blob[offsets[i]:offsets[i+1]]. Everything is memory-mapped and rows are decoded lazily,
+#nothing is unpickled at startup.
+class MetadataStore():
+    def __init__(self, path, columns, n_rows):
+        self.path = path
+        #column name -> 'int' or 'str'
+        self.columns = columns
+        self.n_rows = n_rows
+        self._ints = {}
+        self._offsets = {}
+        self._blobs = {}
+        for column, kind in [(text_column, 'str')] + list(columns.items()):
+            if kind == 'int':
+                self._ints[column] = np.load(os.path.join(path, f"{column}.npy"), mmap_mode='r')
+                continue
+            self._offsets[column] = np.load(os.path.join(path, f"{column}.offsets.npy"), mmap_mode='r')
+            blob_path = os.path.join(path, f"{column}.blob")
+            if os.path.getsize(blob_path):
+                self._blobs[column] = np.memmap(blob_path, dtype=np.uint8, mode='r')
+            else:
+                self._blobs[column] = np.empty(0, dtype=np.uint8)
+
+    @staticmethod
+    def write(path, texts, metadatas):
+        path = os.path.join(path, metadata_dir)
+        os.makedirs(path, exist_ok=True)
+        names = list(dict.fromkeys(key for metadata in metadatas for key in metadata))
+        columns = {}
+        values = {text_column: texts}
+        for column in names:
+            column_values = [metadata.get(column) for metadata in metadatas]
+            if all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in column_values):
+                columns[column] = 'int'
+                np.save(os.path.join(path, f"{column}.npy"), np.array(column_values, dtype=np.int64))
+            else:
+                columns[column] = 'str'
+                values[column] = ["" if value is None else str(value) for value in column_values]
+
+        for column, column_values in values.items():
+            encoded = [value.encode('utf-8') for value in column_values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded])
+            np.save(os.path.join(path, f"{column}.offsets.npy"), offsets)
+            with open(os.path.join(path, f"{column}.blob"), 'wb') as f:
+                f.write(b"".join(encoded))
+
+        with open(os.path.join(path, columns_file), 'w', encoding='utf-8') as f:
+            json.dump({'n_rows': len(texts), 'columns': columns}, f)
+
+    @classmethod
+    def load(cls, path):
+        path = os.path.join(path, metadata_dir)
+        with open(os.path.join(path, columns_file), encoding='utf-8') as f:
+            info = json.load(f)
+        return cls(path, info['columns'], info['n_rows'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, metadata_dir, columns_file))
+
+    #Converts the pickled docstore of a LangChain FAISS store, in index order
+    @staticmethod
+    def from_vectorstore(path, vectorstore):
+        documents = [
+            vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            for i in range(vectorstore.index.ntotal)
+        ]
+        MetadataStore.write(path, [doc.page_content for doc in documents], [doc.metadata for doc in documents])
+
+    def value(self, column, row):
+        if column in self._ints:
+            return int(self._ints[column][row])
+        offsets = self._offsets[column]
+        return bytes(self._blobs[column][offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def get(self, row):
+        return Document(
+            page_content=self.value(text_column, row),
+            metadata={column: self.value(column, row) for column in self.columns}
+        )
+
+    #Docstore interface used by LangChain's FAISS: ids are the row numbers
+    def search(self, search):
+        row = int(search)
+        if not 0 <= row < self.n_rows:
+            return f"ID {search} not found."
+        return self.get(row)
+
+    def __len__(self):
+        return self.n_rows
+
+#Converts the pickled index.pkl of an existing store into the columnar format
+if __name__ == "__main__":
+    from langchain_community.vectorstores import FAISS
+    import registry
+    vector_path = '../data/vectorstore'
+    vectorstore = FAISS.load_local(vector_path, registry.get_embeddings(), allow_dangerous_deserialization=True)
+    MetadataStore.from_vectorstore(vector_path, vectorstore)
+    print("Metadata store written")
@@ -0,0 +1,192 @@
+import argparse
+import os
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+#onnxruntime is optional: only needed when the ONNX encoder is selected
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+#Exported model, its int8 version and the tokenizer live here
+onnx_path = '../data/encoder/onnx'
+model_file = 'model.onnx'
+quantized_file = 'model.int8.onnx'
+tokenizer_file = 'tokenizer.json'
+#Sequence length all-MiniLM-L6-v2 is used with by sentence-transformers
+max_length = 256
+
+#Exports the transformer of a sentence-transformers model to ONNX and quantizes its weights to
+#int8 (dynamic quantization: activations stay float and are quantized per batch at run time)
+def export(model_name, path=onnx_path):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(path, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    #The inputs are passed by name, the positional order of forward() differs between transformers versions
+    class Encoder(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).last_hidden_state
+
+    inputs = tokenizer(["An example query"], return_tensors='pt')
+    names = ['input_ids', 'attention_mask', 'token_type_ids']
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(model),
+            tuple(inputs[name] for name in names),
+            os.path.join(path, model_file),
+            input_names=names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            #The TorchScript exporter; newer torch versions default to dynamo, which fails to target opset 14
+            dynamo=False
+        )
+    quantize_dynamic(os.path.join(path, model_file), os.path.join(path, quantized_file), weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(path)
+    print(f"Exported {model_name} to {path}")
+
+#Drop-in for HuggingFaceEmbeddings running the exported model on ONNX Runtime: same tokenizer,
+#mean pooling over the attention mask and L2 normalization as the sentence-transformers model
+class OnnxEmbeddings(Embeddings):
+    def __init__(self, path=onnx_path, quantized=True, batch_size=32, threads=None):
+        if onnxruntime is None:
+            raise ImportError("The ONNX encoder needs onnxruntime: pip install onnxruntime")
+        from tokenizers import Tokenizer
+
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, tokenizer_file))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, quantized_file if quantized else model_file),
+            options,
+            providers=['CPUExecutionProvider']
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            'input_ids': np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            'attention_mask': np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            'token_type_ids': np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        }
+        hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        mask = inputs['attention_mask'][:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        vectors = [self._encode(texts[start:start + self.batch_size]) for start in range(0, len(texts), self.batch_size)]
+        return np.concatenate(vectors).tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+    @staticmethod
+    def exists(path=onnx_path):
+        return os.path.exists(os.path.join(path, quantized_file))
+
+#How close the encoder's vectors are to the ones stored in the index (which came from the
+#PyTorch model) for a sample of corpus texts, and how much of the top-k they retrieve agrees
+def ParityCheck(encoder, vectorstore, n=200, k=10, seed=0):
+    index = vectorstore.index
+    rows = np.random.default_rng(seed).choice(index.ntotal, size=min(n, index.ntotal), replace=False)
+    texts = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[int(row)]).page_content for row in rows]
+    stored = np.stack([index.reconstruct(int(row)) for row in rows])
+    encoded = np.asarray(encoder.embed_documents(texts), dtype=np.float32)
+
+    def unit(vectors):
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    cosine = (unit(stored) * unit(encoded)).sum(axis=1)
+    _, expected = index.search(stored, k)
+    _, found = index.search(encoded, k)
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(expected, found)]
+    return {
+        'rows': len(rows),
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+        f'top{k}_overlap': float(np.mean(overlap)),
+        'top1_match': float(np.mean(expected[:, 0] == found[:, 0]))
+    }
+
+#Top-k overlap with the stored index the export must reach before it serves queries
+min_overlap = 0.9
+
+#ParityCheck of the int8 export against a store; True when it may replace the PyTorch encoder
+def ValidateEncoder(vectorstore, path=onnx_path, k=10, limit=min_overlap):
+    result = ParityCheck(OnnxEmbeddings(path), vectorstore, k=k)
+    return result[f'top{k}_overlap'] >= limit, result
+
+def _rss_mb():
+    import psutil
+    return psutil.Process().memory_info().rss / 2**20
+
+#Cold start (load plus first query), per-query latency and resident memory added by each encoder
+def CompareEncoders(loaders, queries):
+    report = {}
+    for name, loader in loaders.items():
+        rss = _rss_mb()
+        start = time.perf_counter()
+        encoder = loader()
+        encoder.embed_query(queries[0])
+        cold_start = time.perf_counter() - start
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            encoder.embed_query(query)
+            latencies.append(time.perf_counter() - start)
+        report[name] = {
+            'cold_start_s': cold_start,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'rss_added_mb': _rss_mb() - rss
+        }
+    return report
+
+if __name__ == "__main__":
+    import registry
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from benchmark import LoadQuestions
+    vector_path = '../data/vectorstore'
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export', action='store_true', help="Export and quantize the embedding model")
+    parser.add_argument('--check', action='store_true', help="Compare ONNX embeddings with the stored index vectors")
+    parser.add_argument('--compare', action='store_true', help="Cold-start and per-query latency of both encoders")
+    parser.add_argument('--queries', type=int, default=200, help="Questions used for the latency comparison")
+    args = parser.parse_args()
+
+    if args.export:
+        export(registry.embedding_model)
+    if args.check:
+        vectorstore = registry.get_vectorstore(vector_path)
+        for quantized in (False, True):
+            result = ParityCheck(OnnxEmbeddings(quantized=quantized), vectorstore)
+            print(f"{'int8' if quantized else 'fp32'}: " + ", ".join(f"{key} {value:.4f}" for key, value in result.items()))
+    if args.compare:
+        report = CompareEncoders({
+            'onnx-int8': lambda: OnnxEmbeddings(quantized=True),
+            #A fresh model, the registry's cached one would show no load time or memory
+            'torch': lambda: HuggingFaceEmbeddings(model_name=registry.embedding_model, model_kwargs={'device': 'cpu'})
+        }, LoadQuestions(args.queries))
+        for name, row in report.items():
+            print(f"{name:<10} cold start {row['cold_start_s']:.2f}s, p50 {row['p50_ms']:.2f}ms, p95 {row['p95_ms']:.2f}ms, +{row['rss_added_mb']:.0f} MB")
@@ -1,9 +1,20 @@
 #All the necessary imports
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from langchain.prompts import PromptTemplate
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from reform import rewrite_query, generate_step_back_query, decompose_query
-from retriever import Retriever
+from reform import rewrite_query, generate_queries
+from retriever import Retriever, batch_retrieval, get_document
+from fusion import rank_merge
+from graph import graph_path
+from context import ContextBuilder, estimate_tokens
+import tracing
+import registry
+from relevance import parse_flag, default_thresholds
+
+logger = logging.getLogger(__name__)
 
 #Setting the prompt template for LLM
 custom_prompt_template = """
@@ -36,11 +47,58 @@ Guidelines:
 Condensed Answer:
 """
 
+no_context_answer = "No relevant context was found in the Bhagavad Gita to answer this question."
+not_related_answer = "This question is not related to Bhagwad Gita or Yoga Sutras in any way. Please ask relevant questions only."
+
+#Store handles one request works with. A reload builds a new snapshot instead of changing the
+#shared one, so a request that spans a publish keeps reading the rows of the version it started on.
+StoreSnapshot = namedtuple('StoreSnapshot', ['generation', 'vector_store', 'sparse_index', 'filter_index', 'relevance_gate', 'knowledge_graph'])
+
 class Pipeline():
-    def __init__(self, llm, path_vectorstore):
+    def __init__(self, llm, path_vectorstore, reranker=None, cache=None, stage_workers=8, relevance_gate=True, relevance_thresholds=default_thresholds, multi_query=False, knowledge_graph=False, path_graph=graph_path, context_budget=1500, generation_workers=8):
         self.llm = llm
+        #Pool for the independent stages of a request, shared by concurrent requests
+        self.executor = ThreadPoolExecutor(max_workers=stage_workers)
+        self.reranker = reranker
+        #Retrieve for the rewrite, step-back and sub-queries too, merged by rank fusion
+        self.multi_query = multi_query
+        #Token budget of the passages put into the generation prompt
+        self.context_builder = ContextBuilder(budget=context_budget)
+        #Answers generated at once by GetAnswers
+        self.generation_workers = generation_workers
+        #Optional SemanticCache in front of GetAnswer
+        self.cache = cache
         self.path_vectorstore = path_vectorstore
-        self.vectorstore = self.LoadVectorStore()
+        self.path_graph = path_graph
+        self.use_relevance_gate = relevance_gate
+        self.relevance_thresholds = relevance_thresholds
+        self.use_knowledge_graph = knowledge_graph
+        self._reload_lock = threading.Lock()
+        self.store = self.LoadHandles()
+
+    #Shared store handles of the current version of the store
+    def LoadHandles(self):
+        return StoreSnapshot(
+            generation=registry.refresh(self.path_vectorstore),
+            vector_store=self.LoadVectorStore(),
+            sparse_index=self.LoadSparseIndex(),
+            filter_index=registry.get_filter_index(self.path_vectorstore),
+            #Embedding-based relevance check, the LLM flagging call is only made for borderline queries
+            relevance_gate=registry.get_relevance_gate(self.path_vectorstore, self.relevance_thresholds) if self.use_relevance_gate else None,
+            #Verse graph used to add the neighbours of retrieved shlokas to the context
+            knowledge_graph=registry.get_knowledge_graph(self.path_graph, self.path_vectorstore) if self.use_knowledge_graph else None
+        )
+
+    #Snapshot taken as each request starts and passed through its stages; a new version of the
+    #store is loaded here, once, while other requests keep the snapshot they started with.
+    #Cached answers were built from the old rows, so the cache is cleared too.
+    def Refresh(self):
+        with self._reload_lock:
+            if registry.refresh(self.path_vectorstore) != self.store.generation:
+                self.store = self.LoadHandles()
+                if self.cache is not None:
+                    self.cache.clear()
+            return self.store
 
     def SetCustomPrompt(self):
         return PromptTemplate(
@@ -48,16 +106,13 @@ class Pipeline():
             input_variables=["context", "metadata_ids", "metadata_speakers", "question", 'shlokas']
         )
     
+    #Shared with every other Pipeline in the process, loaded on first use
     def LoadVectorStore(self):
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        self.vector_store = FAISS.load_local(
-            self.path_vectorstore,
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
+        return registry.get_vectorstore(self.path_vectorstore)
+
+    def LoadSparseIndex(self):
+        return registry.get_sparse_index(self.path_vectorstore)
+
     def flagging(self, query):
         flag_prompt = '''
         You are an AI assistant with an expertise in Bhagwad Gita and Patanjali Yoga Sutras. You have to check whether the user query is related to these scriptures or not.
@@ -77,47 +132,317 @@ class Pipeline():
         final_flag_prompt = final_flag_template.format(
             query = query
         )
-        flag = self.llm(final_flag_prompt)
-        return flag
+        with tracing.span('flag') as span:
+            flag = parse_flag(self.llm(final_flag_prompt))
+            span.set(flag=flag)
+        #An unparseable response falls back to answering, the answer prompt has its own out-of-scope guideline
+        return flag if flag is not None else '1'
 
-    def GetAnswer(self, query):
-        flag = self.flagging(query)
-        print(flag)
-        if flag=='1':
+    def EmbedQuery(self, query):
+        with tracing.span('embed'):
+            return self.store.vector_store.embedding_function.embed_query(query)
+
+    def CacheLookup(self, query_embedding):
+        with tracing.span('cache') as span:
+            answer = self.cache.get(query_embedding)
+            span.set(hit=answer is not None)
+            return answer
+
+    #Only answers of the current snapshot are cached, one that finished after a reload is dropped
+    def CachePut(self, store, query, query_embedding, answer):
+        with self._reload_lock:
+            if store is self.store:
+                self.cache.put(query, query_embedding, answer)
+
+    #Row ids matching the metadata filters, e.g. {"source": "Gita", "speaker": "Bhagwan"};
+    #None searches the whole corpus
+    def SelectRows(self, store, filters):
+        if not filters:
+            return None
+        with tracing.span('filter') as span:
+            rows = store.filter_index.select(filters)
+            span.set(rows=len(rows))
+        logger.debug("Filters %s select %d rows", filters, len(rows))
+        return rows
+
+    #Cached answers were retrieved from the whole corpus, so filtered queries skip the cache
+    def GetAnswer(self, query, filters=None):
+        store = self.Refresh()
+        with tracing.trace('request'):
+            if self.cache is None or filters:
+                return self.ComputeAnswer(query, filters=filters, store=store)
+
+            #The embedding is computed once, for the cache lookup and for retrieval
+            query_embedding = self.EmbedQuery(query)
+            answer = self.CacheLookup(query_embedding)
+            if answer is not None:
+                return answer
+            answer = self.ComputeAnswer(query, query_embedding=query_embedding, store=store)
+            if answer is not None:
+                self.CachePut(store, query, query_embedding, answer)
+            return answer
+
+    def RewriteQuery(self, query):
+        with tracing.span('rewrite'):
             rewritten_query = str(rewrite_query(query, self.llm))
-            print(f"Rewritten query: {rewritten_query}")
-            # Retrieve similar questions
-            retriever = Retriever(llm=self.llm, query=query, vectorstore=self.vector_store, alpha=0.3)
-            documents = retriever.samay()
-            if not documents:
-                return "No relevant context was found in the Bhagavad Gita to answer this question."
-
-            # Extract metadata
-            metadata_ids = [doc.metadata.get('id', 'N/A') for doc in documents]
-            metadata_speakers = [doc.metadata.get('speaker', 'Unknown') for doc in documents]
-            metadata_speakers = [", ".join(speaker) if isinstance(speaker, list) else speaker for speaker in metadata_speakers]
-            context = "\n".join([doc.page_content for doc in documents])
-            shlokas = [doc.metadata.get('shloka', 'N/A') for doc in documents]
-            metadata_purport = [doc.metadata.get('purport', 'N/A') for doc in documents]
-            flat_metadata_purport = [item for sublist in metadata_purport for item in sublist]
-
-            # Use prompt template to generate response
-            custom_prompt = self.SetCustomPrompt()
-            final_prompt = custom_prompt.format(
-                context=",".join(flat_metadata_purport),
-                metadata_ids=", ".join(metadata_ids),
-                metadata_speakers=", ".join(metadata_speakers),
-                shlokas=", ".join(shlokas),
-                question=query
-            )
+        logger.debug("Rewritten query: %s", rewritten_query)
+        return rewritten_query
+
+    def RetrieveDocuments(self, store, query, query_embedding=None, rows=None):
+        # Retrieve similar questions
+        retriever = Retriever(llm=self.llm, query=query, vectorstore=store.vector_store, alpha=0.3, sparse_index=store.sparse_index, reranker=self.reranker, query_embedding=query_embedding, rows=rows)
+        return retriever.samay()
+
+    #All query variants are embedded in one batch, searched in one batched FAISS call and
+    #one sparse product, then merged with reciprocal-rank fusion and de-duplicated
+    def RetrieveMultiQuery(self, store, query, query_embedding=None, k=15, rows=None):
+        queries = generate_queries(query, self.llm)
+        logger.debug("Query variants: %s", queries)
+        with tracing.span('embed', queries=len(queries)):
+            embeddings = store.vector_store.embedding_function.embed_documents(queries)
+        if query_embedding is not None:
+            embeddings[0] = query_embedding
+        results = batch_retrieval(queries, embeddings, store.vector_store, store.sparse_index, k=k, alpha=0.3, rows=rows)
+        with tracing.span('rank_merge') as span:
+            ids, _ = rank_merge([ids for ids, _ in results], k)
+            span.set(candidates=len(ids))
+        documents = [get_document(store.vector_store, int(row)) for row in ids]
+        if self.reranker is not None:
+            return self.reranker.rerank(query, documents, 5)
+        return documents
+
+    #Adds the verses linked in the knowledge graph, each right after the retrieved document it
+    #was reached from, so they compete for the context budget at that document's rank.
+    #Linked verses outside the selected rows are left out.
+    def ExpandDocuments(self, store, documents, rows=None):
+        if store.knowledge_graph is None or not documents:
+            return documents
+        with tracing.span('graph') as span:
+            linked = store.knowledge_graph.expand(documents)
+            if rows is not None and linked:
+                linked = [link for link, keep in zip(linked, np.isin([row for _, row in linked], rows)) if keep]
+            span.set(candidates=len(linked))
+        after = {}
+        for rank, row in linked:
+            after.setdefault(rank, []).append(get_document(store.vector_store, row))
+        expanded = []
+        for rank, document in enumerate(documents):
+            expanded.append(document)
+            expanded.extend(after.get(rank, []))
+        return expanded
+
+    #First-stage retrieval, optional reranking and graph expansion, run as one stage
+    def Retrieve(self, store, query, query_embedding=None, rows=None):
+        with tracing.span('retrieve') as span:
+            if self.multi_query:
+                documents = self.RetrieveMultiQuery(store, query, query_embedding, rows=rows)
+            else:
+                documents = self.RetrieveDocuments(store, query, query_embedding, rows)
+            documents = self.ExpandDocuments(store, documents, rows)
+            span.set(documents=len(documents))
+            return documents
+
+    #Final prompt and the retrieval metadata returned alongside the answer. The context is
+    #limited to the token budget of the context builder, best ranked passages first.
+    def BuildPrompt(self, query, documents):
+        with tracing.span('prompt') as span:
+            final_prompt, metadata = self._buildPrompt(query, documents, span)
+        return final_prompt, metadata
+
+    def _buildPrompt(self, query, documents, span):
+        passages, context_tokens = self.context_builder.build(documents)
+        metadata_ids = [passage['id'] for passage in passages]
+        metadata_speakers = [passage['speaker'] for passage in passages]
+        shlokas = [passage['shloka'] for passage in passages]
+
+        # Use prompt template to generate response
+        custom_prompt = self.SetCustomPrompt()
+        final_prompt = custom_prompt.format(
+            context="\n\n".join(f"[{passage['id']}] {passage['purport']}" for passage in passages),
+            metadata_ids=", ".join(metadata_ids),
+            metadata_speakers=", ".join(metadata_speakers),
+            shlokas=", ".join(shlokas),
+            question=query
+        )
+        prompt_tokens = self.context_builder.count_tokens(final_prompt)
+        span.set(documents=len(documents), passages=len(passages), context_tokens=context_tokens, prompt_tokens=prompt_tokens)
+        logger.info("Prompt: ~%d tokens, %d of %d passages (%d context tokens)", prompt_tokens, len(passages), len(documents), context_tokens)
+        metadata = {
+            "metadata_ids": metadata_ids,
+            "metadata_speakers": metadata_speakers,
+            "context": "\n".join(passage['question'] for passage in passages),
+            "shlokas": shlokas
+        }
+        return final_prompt, metadata
+
+    #Flagging and retrieval on the raw query don't depend on each other, so they run
+    #concurrently; the retrieval is dropped when the query is flagged unrelated. The relevance
+    #gate settles most queries up front without the LLM flagging call. A rewritten query is only
+    #retrieved for with multi_query, which searches it alongside the raw query.
+    def RunStages(self, store, query, query_embedding=None, filters=None):
+        rows = self.SelectRows(store, filters)
+        flag = None
+        if store.relevance_gate is not None:
+            if query_embedding is None:
+                query_embedding = self.EmbedQuery(query)
+            with tracing.span('gate') as span:
+                flag = store.relevance_gate.decide(query_embedding)
+                span.set(decision=flag)
+            if flag == '0':
+                return flag, None
+
+        documents_future = tracing.submit(self.executor, self.Retrieve, store, query, query_embedding, rows)
+        if flag is None:
+            flag = self.flagging(query)
+        tracing.annotate(flag=flag)
+        if flag != '1':
+            documents_future.cancel()
+            return flag, None
+        return flag, documents_future.result()
+
+    #Prompt and LLM call for a query whose documents are retrieved
+    def Generate(self, query, documents):
+        if not documents:
+            return no_context_answer
+
+        final_prompt, metadata = self.BuildPrompt(query, documents)
+        with tracing.span('generate') as span:
             final_answer = self.llm(final_prompt)
+            span.set(completion_tokens=estimate_tokens(final_answer))
+
+        return {"answer": final_answer, **metadata}
+
+    #`store` is the snapshot of the request, the current one when called on its own
+    def ComputeAnswer(self, query, query_embedding=None, filters=None, store=None):
+        store = store if store is not None else self.Refresh()
+        with tracing.trace('answer'):
+            flag, documents = self.RunStages(store, query, query_embedding=query_embedding, filters=filters)
+            if flag=='1':
+                return self.Generate(query, documents)
+            elif flag=='0':
+                return not_related_answer
+
+    #Documents of many queries from one batched dense search and one sparse product,
+    #then the per-query reranking and graph expansion of Retrieve
+    def RetrieveBatch(self, store, queries, query_embeddings, k=15, rows=None):
+        if not queries:
+            return []
+        results = batch_retrieval(queries, query_embeddings, store.vector_store, store.sparse_index, k=k, alpha=0.3, rows=rows)
+        batch_documents = []
+        for query, (ids, _) in zip(queries, results):
+            documents = [get_document(store.vector_store, int(row)) for row in ids]
+            if self.reranker is not None:
+                documents = self.reranker.rerank(query, documents, 5)
+            batch_documents.append(self.ExpandDocuments(store, documents, rows))
+        return batch_documents
+
+    #Answers of a batch of queries as (position, answer) pairs, yielded as each one finishes.
+    #All queries are embedded in one forward pass, gated with one matrix product and retrieved
+    #together; flagging of undecided queries and generation run on generation_workers threads.
+    #With multi_query each query's variants are generated and retrieved on those threads instead,
+    #as Retrieve does. Filters apply to every query of the batch.
+    def GetAnswers(self, queries, filters=None):
+        store = self.Refresh()
+        queries = [str(query) for query in queries]
+        return tracing.traced('batch', self._batchAnswers(store, queries, filters), queries=len(queries))
+
+    def _batchAnswers(self, store, queries, filters=None):
+        rows = self.SelectRows(store, filters)
+        cache = self.cache if not filters else None
+        with tracing.span('embed', queries=len(queries)):
+            embeddings = store.vector_store.embedding_function.embed_documents(queries) if queries else []
 
-            return {
-                "answer": final_answer,
-                "metadata_ids": metadata_ids,
-                "metadata_speakers": metadata_speakers,
-                "context": context,
-                "shlokas": shlokas
-            }
+        pending = []
+        for i, (query, embedding) in enumerate(zip(queries, embeddings)):
+            answer = self.CacheLookup(embedding) if cache is not None else None
+            if answer is not None:
+                yield i, answer
+            else:
+                pending.append(i)
+
+        flags = [None] * len(queries)
+        if store.relevance_gate is not None and pending:
+            with tracing.span('gate', queries=len(pending)):
+                for i, flag in zip(pending, store.relevance_gate.decide_many([embeddings[i] for i in pending])):
+                    flags[i] = flag
+        for i in [i for i in pending if flags[i] == '0']:
+            yield i, not_related_answer
+        pending = [i for i in pending if flags[i] != '0']
+
+        #Retrieved for undecided queries too, like RunStages does while the LLM flags them
+        documents = {}
+        if not self.multi_query:
+            documents = dict(zip(pending, self.RetrieveBatch(store, [queries[i] for i in pending], [embeddings[i] for i in pending], rows=rows)))
+
+        def answer(i):
+            flag = flags[i] if flags[i] is not None else self.flagging(queries[i])
+            if flag != '1':
+                return not_related_answer
+            if self.multi_query:
+                return self.Generate(queries[i], self.Retrieve(store, queries[i], embeddings[i], rows))
+            return self.Generate(queries[i], documents[i])
+
+        #Shut down without waiting, so a caller that stops reading the batch cancels the
+        #answers that have not started
+        executor = ThreadPoolExecutor(max_workers=self.generation_workers)
+        try:
+            futures = {tracing.submit(executor, answer, i): i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    #One failed generation does not end the batch
+                    yield i, {"error": f"{type(e).__name__}: {e}"}
+                    continue
+                if cache is not None and result is not None:
+                    self.CachePut(store, queries[i], embeddings[i], result)
+                yield i, result
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    #Streaming variant of GetAnswer: yields a "metadata" event with the retrieved
+    #sources first, then "token" events as the LLM generates, then "done"
+    def StreamAnswer(self, query, filters=None):
+        store = self.Refresh()
+        return tracing.traced('request', self._streamEvents(store, query, filters), stream=True)
+
+    def _streamEvents(self, store, query, filters=None):
+        query_embedding = None
+        cache = self.cache if not filters else None
+        if cache is not None:
+            query_embedding = self.EmbedQuery(query)
+            answer = self.CacheLookup(query_embedding)
+            if answer is not None:
+                yield from self._cachedEvents(answer)
+                return
+
+        flag, documents = self.RunStages(store, query, query_embedding=query_embedding, filters=filters)
+        if flag=='1':
+            if not documents:
+                yield {"type": "token", "text": no_context_answer}
+                yield {"type": "done"}
+                return
+
+            final_prompt, metadata = self.BuildPrompt(query, documents)
+            yield {"type": "metadata", **metadata}
+            tokens = []
+            with tracing.span('generate') as span:
+                for token in self.llm.stream(final_prompt):
+                    tokens.append(token)
+                    yield {"type": "token", "text": token}
+                span.set(completion_tokens=estimate_tokens("".join(tokens)))
+            if cache is not None:
+                self.CachePut(store, query, query_embedding, {"answer": "".join(tokens), **metadata})
         elif flag=='0':
-            return "This question is not related to Bhagwad Gita or Yoga Sutras in any way. Please ask relevant questions only."
\ No newline at end of file
+            yield {"type": "token", "text": not_related_answer}
+        yield {"type": "done"}
+
+    def _cachedEvents(self, answer):
+        if isinstance(answer, dict):
+            metadata = {key: value for key, value in answer.items() if key != "answer"}
+            yield {"type": "metadata", **metadata}
+            yield {"type": "token", "text": answer["answer"]}
+        else:
+            yield {"type": "token", "text": answer}
+        yield {"type": "done"}
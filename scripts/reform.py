@@ -1,4 +1,7 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
 from langchain.prompts import PromptTemplate
+import tracing
 
 def rewrite_query(original_query, llm):
     query_rewrite_template = """You are an AI assistant having a deep understanding of the Bhagwad Gita and the Patanjali Yoga Sutras tasked with reformulating user queries to improve retrieval in a RAG system. 
@@ -16,7 +19,8 @@ def rewrite_query(original_query, llm):
         input_variables=["original_query"]
     ) 
     final_prompt = custom_prompt.format(original_query=original_query)
-    response = llm(final_prompt)
+    with tracing.span('reform.rewrite'):
+        response = llm(final_prompt)
     return str(response)
 
 
@@ -33,7 +37,8 @@ def generate_step_back_query(original_query, llm):
         input_variables=["original_query"]
     ) 
     final_prompt = custom_prompt.format(original_query=original_query)
-    response = llm(final_prompt)
+    with tracing.span('reform.step_back'):
+        response = llm(final_prompt)
     return response
 
 
@@ -56,6 +61,25 @@ def decompose_query(original_query, llm):
         input_variables=["original_query"]
     ) 
     final_prompt = custom_prompt.format(original_query=original_query)
-    response = llm(final_prompt)
+    with tracing.span('reform.decompose'):
+        response = llm(final_prompt)
     sub_queries = [q.strip() for q in response.split('\n') if q.strip() and not q.strip().startswith('Sub-queries:')]
-    return sub_queries
\ No newline at end of file
+    #Drop the "1." style numbering the LLM copies from the example
+    return [re.sub(r'^\s*(\d+[.)]|[-*])\s*', '', q) for q in sub_queries]
+
+
+# Function for generating all query variants at once: the rewrite, the step-back query and
+# the sub-queries are requested concurrently, so this costs one LLM round-trip of latency
+def generate_queries(original_query, llm, max_sub_queries=4):
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        rewrite = tracing.submit(executor, rewrite_query, original_query, llm)
+        step_back = tracing.submit(executor, generate_step_back_query, original_query, llm)
+        sub_queries = tracing.submit(executor, decompose_query, original_query, llm)
+        queries = [original_query, rewrite.result(), step_back.result()] + sub_queries.result()[:max_sub_queries]
+
+    unique_queries = []
+    for query in queries:
+        query = str(query).strip()
+        if query and query.lower() not in {q.lower() for q in unique_queries}:
+            unique_queries.append(query)
+    return unique_queries
\ No newline at end of file
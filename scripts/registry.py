@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from bm25 import BM25Index
+from relevance import RelevanceGate, default_thresholds
+from metastore import MetadataStore
+from graph import KnowledgeGraph
+from filters import FilterIndex
+from onnx_encoder import OnnxEmbeddings, onnx_path
+
+#Process-wide handles, each loaded once on first use and shared by every Pipeline/Retriever.
+#Callers must treat them as read-only.
+embedding_model = "sentence-transformers/all-MiniLM-L6-v2"
+#Query encoder of the process: 'torch' (HuggingFaceEmbeddings) or 'onnx' (the int8 ONNX Runtime
+#export of the same model, see onnx_encoder.py). Choose it before building a Pipeline; switching
+#drops the stores loaded with the previous one.
+encoder_settings = {'backend': 'torch', 'path': onnx_path}
+
+#Written last by Vectorization.py when it publishes a new version of a store
+manifest_file = 'manifest.json'
+
+_lock = threading.RLock()
+_handles = {}
+load_times = {}
+#Handles derived from each vector store, dropped together when a new version is published,
+#and the (manifest mtime, version) they were loaded at
+_store_handles = {}
+_store_versions = {}
+#Bumped per store on every reload, so each Pipeline can tell that it holds old handles
+generations = {}
+
+def _manifest_version(path):
+    with open(os.path.join(path, manifest_file), encoding='utf-8') as f:
+        return json.load(f)['version']
+
+def _manifest_stamp(path):
+    try:
+        return os.stat(os.path.join(path, manifest_file)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _get(key, loader, store=None):
+    with _lock:
+        if store is not None:
+            #Recorded before loading, so a version published meanwhile is picked up by the next refresh
+            if store not in _store_versions:
+                stamp = _manifest_stamp(store)
+                _store_versions[store] = (stamp, _manifest_version(store) if stamp is not None else None)
+            _store_handles.setdefault(store, set()).add(key)
+        if key not in _handles:
+            start = time.perf_counter()
+            _handles[key] = loader()
+            load_times[key] = time.perf_counter() - start
+            print(f"Loaded {key[0]} {key[1]} in {load_times[key]:.2f}s")
+        return _handles[key]
+
+#Checks, with one stat() of the manifest, whether a new version of the store at path was
+#published since its handles were loaded. If so they are dropped and the next get_* call loads
+#the new files; objects already handed out stay usable, their memory maps keep the old files alive.
+def refresh(path):
+    stamp = _manifest_stamp(path)
+    with _lock:
+        if path not in _store_versions or _store_versions[path][0] == stamp:
+            return generations.get(path, 0)
+        version = _manifest_version(path) if stamp is not None else None
+        if version == _store_versions[path][1]:
+            _store_versions[path] = (stamp, version)
+            return generations.get(path, 0)
+        for key in _store_handles.pop(path, set()):
+            _handles.pop(key, None)
+        del _store_versions[path]
+        generations[path] = generations.get(path, 0) + 1
+    print(f"Vector store {path} is now version {version}, reloading")
+    return generations[path]
+
+def use_encoder(backend, path=onnx_path):
+    if backend not in ('torch', 'onnx'):
+        raise ValueError(f"Unknown encoder: {backend}, expected 'torch' or 'onnx'")
+    with _lock:
+        encoder_settings.update(backend=backend, path=path)
+        #Stores loaded so far embed their queries with the previous encoder
+        for key in [key for key in _handles if key[0] == 'vectorstore']:
+            del _handles[key]
+
+def get_embeddings(model_name=embedding_model, encoder=None):
+    backend = encoder or encoder_settings['backend']
+    if backend == 'onnx':
+        path = encoder_settings['path']
+        return _get(('embeddings', f"{model_name}:onnx"), lambda: OnnxEmbeddings(path))
+    return _get(('embeddings', model_name), lambda: HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'}
+    ))
+
+#Stores written by CreateVectorDB keep their documents in the memory-mapped MetadataStore,
+#whose row numbers double as docstore ids; older stores fall back to the pickled index.pkl
+def get_vectorstore(path, model_name=embedding_model):
+    def load():
+        if MetadataStore.exists(path):
+            index = faiss.read_index(os.path.join(path, "index.faiss"))
+            return FAISS(
+                embedding_function=get_embeddings(model_name),
+                index=index,
+                docstore=MetadataStore.load(path),
+                index_to_docstore_id={i: i for i in range(index.ntotal)}
+            )
+        return FAISS.load_local(
+            path,
+            get_embeddings(model_name),
+            allow_dangerous_deserialization=True
+        )
+    return _get(('vectorstore', path), load, store=path)
+
+#Memory-mapped BM25 postings written by CreateVectorDB, built once here for older stores
+def get_sparse_index(path):
+    def load():
+        if BM25Index.exists(path):
+            return BM25Index.load(path)
+        return BM25Index.from_vectorstore(get_vectorstore(path))
+    return _get(('sparse_index', path), load, store=path)
+
+#Per-field row id sets written by CreateVectorDB, built once here for older stores
+def get_filter_index(path):
+    def load():
+        if FilterIndex.exists(path):
+            return FilterIndex.load(path)
+        return FilterIndex.from_vectorstore(get_vectorstore(path))
+    return _get(('filter_index', path), load, store=path)
+
+#Searches the store's own index; (low, high) similarity thresholds, see relevance.py --low/--high
+def get_relevance_gate(path, thresholds=default_thresholds):
+    low, high = thresholds
+    return _get(('relevance_gate', f"{path}:{low}:{high}"), lambda: RelevanceGate.from_vectorstore(get_vectorstore(path), low=low, high=high), store=path)
+
+#Verse graph linked to the rows of a vector store; converted from the pickle on first use
+#when the CSR files have not been written yet
+def get_knowledge_graph(graph_path, vectorstore_path):
+    def load():
+        if KnowledgeGraph.exists(graph_path):
+            graph = KnowledgeGraph.load(graph_path)
+        else:
+            graph = KnowledgeGraph.from_pickle(graph_path)
+            graph.save(graph_path)
+        return graph.attach(get_vectorstore(vectorstore_path))
+    return _get(('knowledge_graph', graph_path), load, store=vectorstore_path)
+
+#Cold-start time in seconds of everything loaded so far
+def report():
+    with _lock:
+        return {f"{kind}:{name}": seconds for (kind, name), seconds in load_times.items()}
@@ -0,0 +1,120 @@
+import re
+import numpy as np
+from indexing import uses_inner_product
+
+#'1' or '0' from an LLM flagging response, None when it contains neither
+def parse_flag(text):
+    match = re.search(r'[01]', str(text))
+    return match.group() if match else None
+
+#Similarity bounds of the gate: queries at or above high are accepted, below low rejected
+default_thresholds = (0.25, 0.45)
+#Nearest rows looked up per query on an L2 index, whose ranking is only cosine for unit vectors
+l2_candidates = 8
+
+#Queries that have nothing to do with either text, for the reject rate of Calibrate
+off_topic_questions = [
+    "What is the capital of France?",
+    "How do I reset my router password?",
+    "Who won the football world cup in 2018?",
+    "What is the boiling point of water at sea level?",
+    "How do I sort a list in Python?",
+    "What is a good recipe for chocolate cake?",
+    "How many moons does Jupiter have?",
+    "What is the exchange rate of the dollar to the euro?",
+    "How do I change a flat tyre?",
+    "Which phone has the best camera this year?"
+]
+
+#Decides whether a query is about the Gita/Yoga Sutras from its cosine similarity to the
+#nearest corpus question, found with a search of the store's own index. Queries between the
+#two thresholds are left to the LLM (None).
+class RelevanceGate():
+    def __init__(self, index, low=default_thresholds[0], high=default_thresholds[1]):
+        self.index = index
+        self.low = low
+        self.high = high
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore, **kwargs):
+        return cls(vectorstore.index, **kwargs)
+
+    #Cosine similarity of each query to its k nearest rows, most similar first. An inner product
+    #index holds normalized vectors, so its scores already are; for L2 indexes the nearest
+    #candidates are reconstructed and scored exactly.
+    def nearest(self, query_embeddings, k=1):
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, self.index.ntotal)
+        if uses_inner_product(self.index):
+            similarities, _ = self.index.search(queries, k)
+            return similarities
+        _, ids = self.index.search(queries, min(max(k, l2_candidates), self.index.ntotal))
+        similarities = np.full(ids.shape, -1.0, dtype=np.float32)
+        for i, row_ids in enumerate(ids):
+            found = row_ids[row_ids >= 0]
+            vectors = self.index.reconstruct_batch(found)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            similarities[i, :len(found)] = vectors @ queries[i]
+        return -np.sort(-similarities, axis=1)[:, :k]
+
+    def similarity(self, query_embedding):
+        return float(self.nearest(query_embedding)[0, 0])
+
+    def classify(self, similarity):
+        if similarity >= self.high:
+            return '1'
+        if similarity < self.low:
+            return '0'
+        return None
+
+    def decide(self, query_embedding):
+        return self.classify(self.similarity(query_embedding))
+
+    #decide() for a batch of embeddings with one index search
+    def decide_many(self, query_embeddings):
+        if len(query_embeddings) == 0:
+            return []
+        return [self.classify(similarity) for similarity in self.nearest(query_embeddings)[:, 0]]
+
+#Share of queries the gate accepts, rejects and leaves to the LLM. With exclude_self the
+#nearest row is skipped, for queries that are themselves rows of the index (leave-one-out).
+def Calibrate(gate, query_embeddings, exclude_self=False):
+    similarities = gate.nearest(query_embeddings, k=2 if exclude_self else 1)[:, -1]
+    decisions = [gate.classify(similarity) for similarity in similarities]
+    return {
+        'queries': len(decisions),
+        'accept': decisions.count('1') / max(len(decisions), 1),
+        'reject': decisions.count('0') / max(len(decisions), 1),
+        'llm': decisions.count(None) / max(len(decisions), 1),
+        'similarity_p10': float(np.percentile(similarities, 10)),
+        'similarity_p50': float(np.percentile(similarities, 50))
+    }
+
+#Accept/reject rates of the thresholds on the corpus questions (which should be accepted, so
+#their reject rate is the false reject rate) and on off-topic questions (which should be rejected)
+if __name__ == "__main__":
+    import argparse
+    import registry
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--low', type=float, default=default_thresholds[0])
+    parser.add_argument('--high', type=float, default=default_thresholds[1])
+    parser.add_argument('--limit', type=int, default=2000, help="Rows of the store to sample")
+    args = parser.parse_args()
+
+    vectorstore = registry.get_vectorstore('../data/vectorstore')
+    gate = RelevanceGate.from_vectorstore(vectorstore, low=args.low, high=args.high)
+    #Rows of the store itself, each scored with its stored vector against its nearest other row
+    rows = np.random.default_rng(0).permutation(vectorstore.index.ntotal)[:args.limit]
+    stored = vectorstore.index.reconstruct_batch(rows)
+    print(f"Thresholds low={args.low} high={args.high}")
+
+    def show(name, report):
+        print(f"{name:<10} n={report['queries']:<6} accept={report['accept']:.1%} reject={report['reject']:.1%} "
+              f"llm={report['llm']:.1%} similarity p10={report['similarity_p10']:.3f} p50={report['similarity_p50']:.3f}")
+    corpus = Calibrate(gate, stored, exclude_self=True)
+    show('corpus', corpus)
+    off_topic = Calibrate(gate, vectorstore.embedding_function.embed_documents(off_topic_questions))
+    show('off-topic', off_topic)
+    print(f"False rejects {corpus['reject']:.1%} of corpus questions, off-topic questions accepted without the LLM {off_topic['accept']:.1%}")
@@ -0,0 +1,109 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from langchain.prompts import PromptTemplate
+import tracing
+
+pointwise_template = """On a scale of 1-10, rate the relevance of the following document to the query. Consider the specific context and intent of the query, not just keyword matches.
+            Query: {query}
+            Document: {doc}
+
+            Please provide only a number between 1 and 10 as the relevance score. Do not include any explanations or additional text.
+            Relevance Score:"""
+
+listwise_template = """On a scale of 1-10, rate the relevance of each of the following numbered documents to the query. Consider the specific context and intent of the query, not just keyword matches.
+            Query: {query}
+
+            Documents:
+            {docs}
+
+            Please answer with one line per document in the form "<document number>: <score>". Do not include any explanations or additional text.
+            Relevance Scores:"""
+
+#First number in the LLM output, 0 if there is none
+def parse_score(text):
+    match = re.search(r'\d+(?:\.\d+)?', str(text))
+    return float(match.group()) if match else 0.0
+
+def parse_listwise_scores(text, n_docs):
+    scores = [0.0] * n_docs
+    for number, score in re.findall(r'(\d+)\s*[:.)\]-]\s*(\d+(?:\.\d+)?)', str(text)):
+        position = int(number) - 1
+        if 0 <= position < n_docs:
+            scores[position] = float(score)
+    return scores
+
+#Orders documents by score within a time budget, falling back to the first-stage order when it runs out
+class Reranker():
+    def __init__(self, time_budget=None, max_workers=1):
+        self.time_budget = time_budget
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def score(self, query, docs, deadline):
+        raise NotImplementedError
+
+    def rerank(self, query, docs, top_n):
+        if not docs:
+            return []
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        scores = self.score(query, docs, deadline)
+        if scores is None:
+            #Out of time budget: the first-stage ranking is kept
+            tracing.annotate(rerank_fallback=True)
+            return docs[:top_n]
+        #Stable sort keeps the first-stage order between equal scores
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [docs[i] for i in order[:top_n]]
+
+    def _remaining(self, deadline):
+        return None if deadline is None else max(0.0, deadline - time.perf_counter())
+
+    def _result(self, future, deadline):
+        try:
+            return future.result(timeout=self._remaining(deadline))
+        except TimeoutError:
+            future.cancel()
+            return None
+
+class LLMReranker(Reranker):
+    #listwise=True scores all documents in one prompt, otherwise one prompt per document through the pool
+    def __init__(self, llm, listwise=False, max_workers=8, time_budget=None):
+        super().__init__(time_budget=time_budget, max_workers=max_workers)
+        self.llm = llm
+        self.listwise = listwise
+
+    def score(self, query, docs, deadline):
+        if self.listwise:
+            return self._result(self.executor.submit(self.scoreListwise, query, docs), deadline)
+
+        prompt_template = PromptTemplate(input_variables=["query", "doc"], template=pointwise_template)
+        futures = [
+            self.executor.submit(self.llm, prompt_template.format(query=query, doc=doc.page_content))
+            for doc in docs
+        ]
+        done, not_done = wait(futures, timeout=self._remaining(deadline))
+        if not_done:
+            for future in not_done:
+                future.cancel()
+            return None
+        return [parse_score(future.result()) for future in futures]
+
+    def scoreListwise(self, query, docs):
+        prompt_template = PromptTemplate(input_variables=["query", "docs"], template=listwise_template)
+        numbered_docs = "\n            ".join(f"{i + 1}. {doc.page_content}" for i, doc in enumerate(docs))
+        response = self.llm(prompt_template.format(query=query, docs=numbered_docs))
+        return parse_listwise_scores(response, len(docs))
+
+#Local CPU cross-encoder, one batched forward pass over all (query, document) pairs
+class CrossEncoderReranker(Reranker):
+    def __init__(self, model_name='cross-encoder/ms-marco-MiniLM-L-6-v2', batch_size=32, time_budget=None):
+        super().__init__(time_budget=time_budget)
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device='cpu')
+        self.batch_size = batch_size
+
+    def score(self, query, docs, deadline):
+        pairs = [(query, doc.page_content) for doc in docs]
+        future = self.executor.submit(self.model.predict, pairs, batch_size=self.batch_size)
+        scores = self._result(future, deadline)
+        return None if scores is None else [float(s) for s in scores]
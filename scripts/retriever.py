@@ -1,67 +1,149 @@
-from langchain.prompts import PromptTemplate
-from rank_bm25 import BM25Okapi
-from typing import List
-from langchain.docstore.document import Document
+import time
+import faiss
 import numpy as np
+from bm25 import tokenize
+from fusion import HybridFusion
+from reranker import LLMReranker
+from indexing import normalize, uses_inner_product
+import tracing
+
+def get_document(vectorstore, row):
+    return vectorstore.docstore.search(vectorstore.index_to_docstore_id[row])
+
+#Selections of up to exact_search_limit rows and exact_search_fraction of the index are searched
+#exactly over their own vectors, so the cost shrinks with the selection; larger ones use a FAISS
+#ID selector on the index itself, where gathering the vectors would cost more than it saves
+exact_search_limit = 4096
+exact_search_fraction = 0.25
+
+#Search parameters of the index with only `rows` allowed. HNSW and IVF parameters would
+#otherwise reset efSearch/nprobe to the FAISS defaults.
+def search_parameters(index, rows):
+    selector = faiss.IDSelectorBatch(rows)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+#Brute-force k-NN over the vectors of the selected rows only
+def subset_search(index, embeddings, k, rows):
+    if len(rows) == 0:
+        return np.empty((len(embeddings), 0), dtype=np.float32), np.empty((len(embeddings), 0), dtype=np.int64)
+    vectors = index.reconstruct_batch(rows)
+    distances, positions = faiss.knn(embeddings, vectors, min(k, len(rows)), metric=index.metric_type)
+    return distances, np.where(positions >= 0, rows[positions], -1)
+
+#Top-k row ids and distances (lower is better) for a batch of query embeddings in one FAISS call.
+#`rows` (sorted row ids, see filters.py) restricts the search to those rows.
+def dense_search(index, embeddings, k, rows=None):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if uses_inner_product(index):
+        embeddings = normalize(embeddings)
+    if rows is None:
+        distances, ids = index.search(embeddings, k)
+    elif len(rows) <= min(exact_search_limit, exact_search_fraction * index.ntotal):
+        distances, ids = subset_search(index, embeddings, k, rows)
+    else:
+        distances, ids = index.search(embeddings, k, params=search_parameters(index, rows))
+    results = []
+    for row_ids, row_distances in zip(ids, distances):
+        found = row_ids != -1
+        #Inner-product indexes return similarities, negate them so lower is better like L2
+        row_distances = -row_distances[found] if uses_inner_product(index) else row_distances[found]
+        results.append((row_ids[found], row_distances))
+    return results
+
+#Hybrid retrieval of many queries at once: one batched FAISS search and one sparse
+#matrix product for all of them, then fusion per query. Returns (row ids, scores) per query.
+#Seconds spent per stage are added to `timings` when a dict is given. With `rows` only those
+#rows are searched on both sides.
+def batch_retrieval(queries, query_embeddings, vectorstore, sparse_index, k=15, alpha=0.5, candidates=50, fusion='alpha', timings=None, rows=None):
+    timings = {} if timings is None else timings
+    candidates = max(k, candidates)
+
+    start = time.perf_counter()
+    with tracing.span('dense', queries=len(queries)) as span:
+        dense = dense_search(vectorstore.index, query_embeddings, candidates, rows)
+        span.set(candidates=sum(len(ids) for ids, _ in dense))
+    timings['dense'] = timings.get('dense', 0.0) + time.perf_counter() - start
+
+    start = time.perf_counter()
+    with tracing.span('sparse', queries=len(queries)) as span:
+        sparse = sparse_index.batch_top_k([tokenize(query) for query in queries], candidates, rows)
+        span.set(candidates=sum(len(ids) for ids, _ in sparse))
+    timings['sparse'] = timings.get('sparse', 0.0) + time.perf_counter() - start
+
+    start = time.perf_counter()
+    with tracing.span('fusion', queries=len(queries)) as span:
+        fusion = HybridFusion(method=fusion, alpha=alpha)
+        results = [
+            fusion.fuse(dense_ids, dense_distances, sparse_ids, sparse_scores, k)
+            for (dense_ids, dense_distances), (sparse_ids, sparse_scores) in zip(dense, sparse)
+        ]
+        span.set(candidates=sum(len(ids) for ids, _ in results))
+    timings['fusion'] = timings.get('fusion', 0.0) + time.perf_counter() - start
+    return results
 
 class Retriever():
-    def __init__(self, query, vectorstore, k=15, top_n=5, alpha = 0.5, llm=None):
+    def __init__(self, query, vectorstore, k=15, top_n=5, alpha = 0.5, llm=None, sparse_index=None, candidates=50, fusion='alpha', reranker=None, query_embedding=None, rows=None):
         self.llm = llm
         self.query = query
         self.vectorstore = vectorstore
         self.k = k
         self.n = top_n
         self.alpha = alpha
+        #Size of the candidate set fetched from each side before fusion
+        self.candidates = candidates
+        self.fusion = HybridFusion(method=fusion, alpha=alpha)
+        self.reranker = reranker
+        #Callers that already embedded the query (e.g. for the answer cache) pass it in
+        self.query_embedding = query_embedding
+        #Row ids the search is restricted to (see filters.py), None for the whole corpus
+        self.rows = rows
+        #The shared index of the store (registry.get_sparse_index); building one here would cost a
+        #full pass over the corpus on every query
+        if sparse_index is None:
+            raise ValueError("Retriever needs the store's sparse_index, see registry.get_sparse_index")
+        self.sparse_index = sparse_index
 
-    def create_bm25_index(self, documents: List[Document]) -> BM25Okapi:
-        tokenized_docs = [doc.page_content.split() for doc in documents]
-        return BM25Okapi(tokenized_docs)
-
-    def initialRetrieval(self):
-        all_docs = self.vectorstore.similarity_search("", k=self.vectorstore.index.ntotal)
-        bm25 = self.create_bm25_index(all_docs)
-        bm25_scores = bm25.get_scores(self.query.split())
-        vector_results = self.vectorstore.similarity_search_with_score(self.query, k=len(all_docs))
+    def getDocument(self, row):
+        return get_document(self.vectorstore, row)
 
-        vector_scores = np.array([score for _, score in vector_results])
-        vector_scores = 1 - (vector_scores - np.min(vector_scores)) / (np.max(vector_scores) - np.min(vector_scores))
-        bm25_scores = (bm25_scores - np.min(bm25_scores)) / (np.max(bm25_scores) - np.min(bm25_scores))
+    #Dense top-k' candidates as FAISS row ids and distances
+    def denseSearch(self, k):
+        embedding = self.query_embedding
+        if embedding is None:
+            with tracing.span('embed'):
+                embedding = self.vectorstore.embedding_function.embed_query(self.query)
+        with tracing.span('dense') as span:
+            ids, distances = dense_search(self.vectorstore.index, [embedding], k, self.rows)[0]
+            span.set(candidates=len(ids))
+        return ids, distances
 
-        combined_scores = self.alpha * vector_scores + (1 - self.alpha) * bm25_scores
-        sorted_indices = np.argsort(combined_scores)[::-1]
+    #Sparse top-k' candidates as row ids and BM25 scores
+    def sparseSearch(self, k):
+        with tracing.span('sparse') as span:
+            ids, scores = self.sparse_index.top_k(tokenize(self.query), k, self.rows)
+            span.set(candidates=len(ids))
+        return ids, scores
 
-        return [all_docs[i] for i in sorted_indices[:self.k]]
+    def initialRetrieval(self):
+        candidates = max(self.k, self.candidates)
+        dense_ids, dense_distances = self.denseSearch(candidates)
+        sparse_ids, sparse_scores = self.sparseSearch(candidates)
+        with tracing.span('fusion') as span:
+            ids, _ = self.fusion.fuse(dense_ids, dense_distances, sparse_ids, sparse_scores, self.k)
+            span.set(candidates=len(ids))
+        return [self.getDocument(int(i)) for i in ids]
 
     def reRanking(self, initial_docs):
-        prompt_template = PromptTemplate(
-            input_variables=["query", "doc"],
-            template="""On a scale of 1-10, rate the relevance of the following document to the query. Consider the specific context and intent of the query, not just keyword matches.
-            Query: {query}
-            Document: {doc}
-
-            Please provide only a number between 1 and 10 as the relevance score. Do not include any explanations or additional text.
-            Relevance Score:"""
-        )
-        scored_docs = []
-        for doc in initial_docs:
-            final_prompt = prompt_template.format(
-                query = self.query,
-                doc = doc
-            )
-            score = self.llm(final_prompt)
-            print(score)
-            try:
-                score = float(score)
-            except ValueError:
-                score = 0  # Default score if parsing fails
-            scored_docs.append((doc, score))
-            print(f"doc processed")
-
-            print(score)
-        
-        reranked_docs = sorted(scored_docs, key=lambda x: x[1], reverse=True)
-        return [doc for doc, _ in reranked_docs[:self.top_n]]
+        reranker = self.reranker if self.reranker is not None else LLMReranker(self.llm)
+        with tracing.span('rerank', candidates=len(initial_docs)):
+            return reranker.rerank(self.query, initial_docs, self.n)
     
     def samay(self):
         initial_docs = self.initialRetrieval()
+        if self.reranker is not None:
+            return self.reRanking(initial_docs)
         return initial_docs
\ No newline at end of file
@@ -1,53 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import requests
-import time
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from checkpoint import Checkpoint
+
+#Raw pages already fetched and the purports found so far per verse, so a re-run resumes
+cache_path = '../data/scrape/cache'
+checkpoint_path = '../data/scrape/verse_purports.jsonl'
+
+base_url = "https://asitis.com"
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+#Allows `rate` requests per second on average with bursts of up to `capacity`, shared by all workers
+class TokenBucket():
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#On-disk cache of responses, one JSON file per URL. Only final answers (200 and 404) are kept,
+#so errors are fetched again on the next run.
+class ResponseCache():
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            with open(self._file(url), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, status, text):
+        #Written to a temporary file first so a crash never leaves half a page behind
+        path = self._file(url)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'status': status, 'text': text}, f)
+        os.replace(path + '.tmp', path)
+
+#Fetches commentaries from https://asitis.com (or base_url, e.g. a local stub server) over one
+#pooled session, at most `concurrency` requests in flight and `rate` requests per second
+class Scraper():
+    def __init__(self, base_url=base_url, concurrency=8, rate=4, burst=None, cache_dir=cache_path, retries=3, backoff=2, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.cache = ResponseCache(cache_dir)
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        #Pages fetched and pages served from the cache, counted from every worker
+        self.fetched = 0
+        self.cached = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    #(status, text) of a page, from the cache when it was fetched before
+    def fetch(self, url):
+        cached = self.cache.get(url)
+        if cached is not None:
+            self._count('cached')
+            return cached['status'], cached['text']
+        for attempt in range(self.retries):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code == 404:
+                    self.cache.put(url, 404, "")
+                    return 404, ""
+                response.raise_for_status()
+                self._count('fetched')
+                self.cache.put(url, response.status_code, response.text)
+                return response.status_code, response.text
+            except requests.exceptions.RequestException as e:
+                print(f"Error scraping {url}: {str(e)}")
+                if attempt == self.retries - 1:
+                    raise
+                #Exponential backoff instead of a fixed sleep
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def url(self, chapter, verse):
+        return f"{self.base_url}/{chapter}/{verse}.html"
+
+    #Purport of a verse, or None when the page has none
+    def purport(self, chapter, verse):
+        status, text = self.fetch(self.url(chapter, verse))
+        if status != 200:
+            return None
+        purport_div = BeautifulSoup(text, 'html.parser').find('div', class_='Purport')
+        if purport_div:
+            return purport_div.get_text(strip=True)
+        return None
+
+#Purports of the (chapter, verse) pairs of `verses`, one request per verse however many rows share
+#it. Verses whose page has no purport get None; verses that kept failing are left out, so the
+#next run tries them again. Results are checkpointed by page URL, so another base_url (e.g. a
+#stub server) does not reuse them.
+def scrape_purports(verses, scraper, checkpoint=checkpoint_path):
+    checkpoint = Checkpoint(checkpoint)
+    keys = [(int(chapter), int(verse)) for chapter, verse in verses[['chapter', 'verse']].drop_duplicates().itertuples(index=False, name=None)]
+    pending = [(chapter, verse) for chapter, verse in keys if scraper.url(chapter, verse) not in checkpoint.results]
+    print(f"Resuming with {len(keys) - len(pending)} verses done, {len(pending)} to scrape")
+
+    with ThreadPoolExecutor(max_workers=scraper.concurrency) as executor:
+        futures = {executor.submit(scraper.purport, chapter, verse): (chapter, verse) for chapter, verse in pending}
+        for future in as_completed(futures):
+            chapter, verse = futures[future]
+            try:
+                purport = future.result()
+            except requests.exceptions.RequestException:
+                #Not checkpointed, so the next run tries this verse again
+                print(f"Giving up on chapter {chapter}, verse {verse} for this run")
+                continue
+            print(f"Purport {'found' if purport else 'not found'} for chapter {chapter}, verse {verse}")
+            checkpoint.add({'key': scraper.url(chapter, verse), 'purport': purport})
 
-data =pd.read_csv('../data/processed/clustered4.csv')
-
-#Function to scrape commentaries from https://asitis.com
-def scrape():
-    purports = []
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    for i in range(len(data)):
-        if data['Source'][i] == 'Gita':
-            chapter = data['chapter'][i]
-            verse = data['verse'][i]
-            url = f"https://asitis.com/{chapter}/{verse}.html"
-            retries = 3
-            #incase scraping fails
-            while retries > 0:
-                try:
-                    print(f"Attempting to scrape {url}, retries left: {retries}")
-                    response = requests.get(url, headers=headers)
-                    response.raise_for_status()
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    purport_div = soup.find('div', class_='Purport')
-                    if purport_div:
-                        purport = purport_div.get_text(strip=True)
-                        print(f"Purport found for chapter {chapter}, verse {verse}")
-                    else:
-                        purport = data['translation'][i]
-                        print(f"Purport not found for chapter {chapter}, verse {verse}")
-                    purports.append(purport)
-                    break
-                except requests.exceptions.RequestException as e:
-                    print(f"Error scraping {url}: {str(e)}")
-                    retries -= 1
-                    if retries > 0:
-                        print("Retrying after 10 seconds...")
-                        time.sleep(10)
-                    else:
-                        purports.append(data['translation'][i])
-        else:
-            purports.append(data['translation'][i])
-    #adding it to dataset
-    data['purport'] = purports
-    data.to_csv('../data/processed/clustered5.csv', index=False)
-    print("Done with scraping")
-
-if __name__ == '__main__':
-    print("Starting scraping")
-    scrape()
\ No newline at end of file
+    print(f"Done with scraping: {scraper.fetched} pages fetched, {scraper.cached} from cache")
+    found = [(chapter, verse) for chapter, verse in keys if scraper.url(chapter, verse) in checkpoint.results]
+    return pd.DataFrame({
+        'chapter': [chapter for chapter, _ in found],
+        'verse': [verse for _, verse in found],
+        'purport': [checkpoint.results[scraper.url(chapter, verse)]['purport'] for chapter, verse in found]
+    })
@@ -0,0 +1,100 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import requests
+from requests.adapters import HTTPAdapter
+import tracing
+
+#Raised when every worker is busy and the waiting queue is full
+class Overloaded(Exception):
+    pass
+
+#Minimal Ollama client over one pooled HTTP session, callable like the LangChain LLMs
+class OllamaClient():
+    def __init__(self, base_url='http://localhost:11434', model='llama3.2', pool_size=16, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.model = model
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    #Exact token counts reported by Ollama replace the estimates on the current span
+    @staticmethod
+    def _annotate(body):
+        counts = {}
+        if body.get('prompt_eval_count') is not None:
+            counts['prompt_tokens'] = body['prompt_eval_count']
+        if body.get('eval_count') is not None:
+            counts['completion_tokens'] = body['eval_count']
+        tracing.annotate(**counts)
+
+    def __call__(self, prompt):
+        response = self.session.post(
+            f"{self.base_url}/api/generate",
+            json={'model': self.model, 'prompt': prompt, 'stream': False},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        body = response.json()
+        self._annotate(body)
+        return body['response']
+
+    def stream(self, prompt):
+        with self.session.post(
+            f"{self.base_url}/api/generate",
+            json={'model': self.model, 'prompt': prompt, 'stream': True},
+            timeout=self.timeout,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get('response'):
+                    yield chunk['response']
+                if chunk.get('done'):
+                    self._annotate(chunk)
+                    break
+
+#Runs pipeline requests on a bounded worker pool. At most max_workers requests run
+#at once and max_queue more may wait; beyond that requests are rejected with Overloaded.
+class QueryService():
+    def __init__(self, pipeline, max_workers=8, max_queue=32, timeout=120):
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        #Requests holding a slot, running or queued
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    #Streaming responses run on the web server's own thread and only take a slot
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            tracing.metrics.count('rag_rejected_requests_total', {})
+            raise Overloaded("Too many requests in flight, try again later")
+        with self._lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    #Raises Overloaded when the queue is full and TimeoutError when the request takes too long.
+    #A timed out request keeps its slot until the pipeline actually finishes.
+    def GetAnswer(self, query, filters=None):
+        self.acquire()
+        try:
+            future = self.executor.submit(self.pipeline.GetAnswer, query, filters)
+        except BaseException:
+            self.release()
+            raise
+        future.add_done_callback(lambda _: self.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise TimeoutError(f"Request did not finish within {self.timeout}s")
@@ -0,0 +1,103 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+
+#Local stand-in for https://asitis.com with the same /{chapter}/{verse}.html pages, so the scraper
+#can be run and checked without the network. Chapters above `chapters` are 404s, verses listed in
+#`no_purport` have a page without a purport, and every `fail_every`-th request is a 500.
+class StubSite():
+    def __init__(self, port=0, chapters=18, no_purport=(), fail_every=0):
+        self.chapters = chapters
+        self.no_purport = set(no_purport)
+        self.fail_every = fail_every
+        self.requests = 0
+        self._lock = threading.Lock()
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.reply(*site.page(self.path))
+
+            def reply(self, status, body=''):
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @staticmethod
+    def purport(chapter, verse):
+        return f"Purport of chapter {chapter}, verse {verse}."
+
+    #(status, html) of a path
+    def page(self, path):
+        with self._lock:
+            self.requests += 1
+            failing = self.fail_every and self.requests % self.fail_every == 0
+        if failing:
+            return 500, ''
+        try:
+            chapter, verse = (int(part) for part in path.strip('/').removesuffix('.html').split('/'))
+        except ValueError:
+            return 404, ''
+        if not 1 <= chapter <= self.chapters:
+            return 404, ''
+        if (chapter, verse) in self.no_purport:
+            return 200, '<html><body></body></html>'
+        return 200, f"<html><body><div class='Purport'>{self.purport(chapter, verse)}</div></body></html>"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+#Scrapes a few verses from a stub site, with failing requests, a 404 and a page without a purport,
+#then again to check that the second run is served from the checkpoint without any request
+def SelfCheck():
+    from scrapper import Scraper, scrape_purports
+
+    site = StubSite(no_purport={(2, 3)}, fail_every=5).start()
+    directory = tempfile.mkdtemp()
+    try:
+        verses = pd.DataFrame({'chapter': [1, 1, 2, 2, 2, 19], 'verse': [1, 2, 1, 2, 3, 1]})
+        checkpoint = os.path.join(directory, 'purports.jsonl')
+        scraper = Scraper(base_url=site.url, concurrency=4, rate=100, cache_dir=os.path.join(directory, 'cache'), backoff=0.01)
+        purports = scrape_purports(verses, scraper, checkpoint)
+        found = {(row.chapter, row.verse): row.purport for row in purports.itertuples()}
+        assert found[(1, 2)] == StubSite.purport(1, 2), found
+        assert found[(2, 3)] is None and found[(19, 1)] is None, found
+        assert len(found) == 6 and scraper.fetched == 5, (found, scraper.fetched)
+
+        requests = site.requests
+        scrape_purports(verses, scraper, checkpoint)
+        assert site.requests == requests, "the second run should not request anything"
+        print(f"Stub site check passed: {len(found)} verses, {requests} requests with retries")
+    finally:
+        site.stop()
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fail-every', type=int, default=0, help="Answer every n-th request with a 500")
+    parser.add_argument('--check', action='store_true', help="Run the scraper against a stub site and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        SelfCheck()
+    else:
+        site = StubSite(port=args.port, fail_every=args.fail_every)
+        print(f"Serving stub pages on {site.url}, e.g. python ingest.py --base-url {site.url}")
+        site.server.serve_forever()
@@ -0,0 +1,287 @@
+import contextvars
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+#Span of the stage running in the current thread/context, None outside a traced request
+_current = contextvars.ContextVar('span', default=None)
+_trace_ids = itertools.count(1)
+logger = logging.getLogger(__name__)
+
+#Upper bounds in seconds of the stage latency histogram buckets
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#Prometheus text format: a histogram of stage latencies, and counters of requests and of the
+#numeric span attributes (candidates, tokens, ...) per stage
+class Metrics():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            counts, total = self.histograms.get(stage, ([0] * (len(buckets) + 1), 0.0))
+            for i, bound in enumerate(buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.histograms[stage] = (counts, total + seconds)
+
+    def count(self, name, labels, value=1):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    #Gauges are read when /metrics is scraped, e.g. requests in flight
+    def gauge(self, name, function, help=""):
+        self.gauges[name] = (function, help)
+
+    @staticmethod
+    def _labels(labels):
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+    def render(self):
+        lines = [
+            "# HELP rag_stage_seconds Latency of each pipeline stage",
+            "# TYPE rag_stage_seconds histogram"
+        ]
+        with self._lock:
+            for stage, (counts, total) in sorted(self.histograms.items()):
+                for bound, count in zip(buckets, counts):
+                    lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {counts[-1]}')
+                lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {counts[-1]}')
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, (function, help) in sorted(self.gauges.items()):
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {function()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class Span():
+    def __init__(self, name, trace, parent, attributes):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+#All spans of one request, including those of stages run on other threads
+class Trace():
+    def __init__(self, name):
+        self.id = next(_trace_ids)
+        self.name = name
+        self.spans = []
+        self.threads = {threading.get_ident()}
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+            self.threads.add(threading.get_ident())
+
+    def thread_ids(self):
+        with self._lock:
+            return list(self.threads)
+
+    #Finished spans of the stages, without the root
+    def finished(self, root):
+        with self._lock:
+            return [span for span in self.spans if span is not root and span.duration is not None]
+
+    #One log line: total time, then each finished stage with its attributes
+    def summary(self, root):
+        parts = [f"trace {self.id} {root.name} {root.duration * 1000:.1f}ms"]
+        for span in sorted(self.finished(root), key=lambda span: span.start):
+            attributes = "".join(f" {key}={value}" for key, value in span.attributes.items())
+            parts.append(f"{span.name} {span.duration * 1000:.1f}ms{attributes}")
+        return " | ".join(parts)
+
+#With log, the summary of every request is logged at INFO level (off by default, the spans already
+#feed the metrics). Slow-request hook: requests slower than slow_threshold seconds are logged with
+#their spans at WARNING level and, for the profile_rate fraction of requests that were sampled, the
+#folded stacks seen while they ran are written to profile_dir (flamegraph.pl / speedscope format)
+#and passed to on_slow. on_trace, when set, is called with every finished trace and its root span.
+settings = {
+    'log': False,
+    'slow_threshold': None,
+    'profile_rate': 0.0,
+    'profile_interval': 0.005,
+    'profile_dir': '../data/profiles',
+    'on_slow': None,
+    'on_trace': None
+}
+
+def configure(**options):
+    unknown = set(options) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown tracing options: {sorted(unknown)}")
+    settings.update(options)
+
+#Samples the stacks of the threads working on a trace every `interval` seconds
+class SamplingProfiler():
+    def __init__(self, trace, interval=0.005):
+        self.trace = trace
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread in self.trace.thread_ids():
+                frame = frames.get(thread)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+def _finish(trace, root):
+    stacks = trace.profiler.stop() if trace.profiler is not None else None
+    outcome = root.attributes.get('outcome', 'ok')
+    metrics.count('rag_requests_total', {'outcome': outcome})
+    slow = settings['slow_threshold'] is not None and root.duration > settings['slow_threshold']
+    if slow:
+        metrics.count('rag_slow_requests_total', {})
+    if slow:
+        logger.warning("SLOW %s", trace.summary(root))
+    elif settings['log']:
+        logger.info(trace.summary(root))
+    if slow and stacks:
+        os.makedirs(settings['profile_dir'], exist_ok=True)
+        path = os.path.join(settings['profile_dir'], f"trace-{trace.id}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.warning("Profile of trace %d written to %s", trace.id, path)
+    if slow and settings['on_slow'] is not None:
+        settings['on_slow'](trace, root, stacks)
+    if settings['on_trace'] is not None:
+        settings['on_trace'](trace, root)
+
+#Times a stage. Inside a traced request the span joins its trace; outside one it only feeds the
+#metrics. Numeric attributes (candidates, tokens, ...) are also summed per stage.
+@contextmanager
+def span(name, **attributes):
+    parent = _current.get()
+    trace = parent.trace if parent is not None else None
+    current = Span(name, trace, parent, attributes)
+    if trace is not None:
+        trace.add(current)
+    token = _current.set(current) if trace is not None else None
+    try:
+        yield current
+    except GeneratorExit:
+        current.set(cancelled=True)
+        raise
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                #A generator closed from another context, e.g. an abandoned stream
+                pass
+        metrics.observe(name, current.duration)
+        for key, value in current.attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics.count(f"rag_stage_{key}_total", {'stage': name}, value)
+
+#Root span of a request; nested calls (e.g. ComputeAnswer inside GetAnswer) become plain spans
+@contextmanager
+def trace(name, **attributes):
+    if _current.get() is not None:
+        with span(name, **attributes) as current:
+            yield current
+        return
+
+    request = Trace(name)
+    root = Span(name, request, None, attributes)
+    request.add(root)
+    if settings['profile_rate'] and random.random() < settings['profile_rate']:
+        request.profiler = SamplingProfiler(request, settings['profile_interval']).start()
+    token = _current.set(root)
+    try:
+        yield root
+    except GeneratorExit:
+        #The client stopped reading a streamed response
+        root.set(outcome='cancelled')
+        raise
+    except BaseException as e:
+        root.set(outcome='error', error=type(e).__name__)
+        raise
+    finally:
+        root.duration = time.perf_counter() - root.start
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass
+        metrics.observe(name, root.duration)
+        _finish(request, root)
+
+#Runs a generator as one traced request. Each step runs in a context of its own, so the span is
+#only current while the generator runs: between items the caller's context is untouched, and
+#requests it makes meanwhile are traced on their own. Closing it early records 'cancelled'.
+def traced(name, generator, **attributes):
+    context = contextvars.copy_context()
+    manager = trace(name, **attributes)
+    context.run(manager.__enter__)
+    try:
+        while True:
+            try:
+                item = context.run(next, generator)
+            except StopIteration:
+                break
+            yield item
+    except BaseException as e:
+        if isinstance(e, GeneratorExit):
+            context.run(generator.close)
+        context.run(manager.__exit__, type(e), e, e.__traceback__)
+        raise
+    context.run(manager.__exit__, None, None, None)
+
+#Adds attributes to the span of the current stage, e.g. token counts reported by the LLM server
+def annotate(**attributes):
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+#executor.submit that carries the current span over to the worker thread
+def submit(executor, function, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
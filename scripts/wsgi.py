@@ -0,0 +1,7 @@
+#WSGI entry point for a production server, run from the scripts folder, e.g.
+#   waitress-serve --threads 40 --port 5000 wsgi:application
+#   gunicorn --workers 1 --threads 40 --bind 127.0.0.1:5000 wsgi:application
+#Use one process with threads: the stores, the answer cache and QueryService's limits are per
+#process, so each extra worker loads another copy and admits another max_workers requests.
+#40 threads lets QueryService queue max_queue requests behind its 8 workers and answer 503 beyond.
+from app import app as application